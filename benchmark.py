@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""
+weasysuite.benchmark
+--------------------
+
+A script measuring the speed of WeasyPrint on a sample of tests.
+
+The sample is stable between runs and versions, and includes tests of each
+chapter. Results are stored in the results of the version, and results of
+two versions can be compared with ``--compare OLD NEW``.
+
+:copyright: Copyright 2011-2012 Simon Sapin, 2013-2016 Kozea
+:license: BSD, see LICENSE for details.
+
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import sys
+import time
+from datetime import datetime
+
+import numpy
+from weasyprint import HTML
+
+from web import (
+    BASE_PATH, FOLDER, RENDERER, STYLESHEET, SUITES, URL_FETCHER, VERSION,
+    add_suite, find_file, parser)
+from workers import peak_rss, reset_peak_rss
+
+
+parser = argparse.ArgumentParser(parents=[parser])
+parser.add_argument('--sample', type=int, default=200)
+parser.add_argument('--repeat', type=int, default=5)
+parser.add_argument('--warmup', type=int, default=1)
+parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+options = parser.parse_args()
+
+logging.getLogger('weasyprint').setLevel(100)
+
+BENCHMARK = 'benchmark.json'
+# Slowdowns are significant when the probability to get them by chance is
+# lower than ALPHA, and when they're greater than THRESHOLD
+ALPHA = 0.01
+THRESHOLD = 1.05
+
+
+def benchmark_filename(version):
+    return os.path.join(FOLDER, 'results', version, BENCHMARK)
+
+
+def read_benchmark(name):
+    """Read the results of a benchmark, given as a filename or a version."""
+    filename = name if os.path.isfile(name) else benchmark_filename(name)
+    with open(filename) as fd:
+        return json.load(fd)
+
+
+def sample_tests(size):
+    """Get a stable sample of about ``size`` tests, stratified by chapter.
+
+    Each chapter gives a number of tests proportional to its size, at least
+    one. Tests are chosen by the hash of their ids, so that the same tests
+    are chosen for all the versions.
+
+    """
+    chapters = []
+    for suite_name, suite in sorted(SUITES.items()):
+        for _, sections, _ in suite['chapters']:
+            filenames = {
+                test['test_id']: find_file(suite_name, test['test_id'])
+                for _, _, tests in sections for test in tests}
+            chapters.append(sorted(
+                (test_id, filename) for test_id, filename in filenames.items()
+                if filename))
+    number = sum(len(tests) for tests in chapters)
+    for tests in chapters:
+        if tests:
+            tests.sort(key=lambda test: hashlib.sha1(
+                test[0].encode()).hexdigest())
+            yield from tests[:max(1, round(size * len(tests) / number))]
+
+
+def render(filename):
+    """Render a test, return its number of pages."""
+    document = HTML(
+        filename, encoding='utf8', url_fetcher=URL_FETCHER).render(
+            stylesheets=[STYLESHEET], presentational_hints=True)
+    document.write_image_surface()
+    return len(document.pages)
+
+
+def u_distribution(n, m):
+    """Get the numbers of orderings of two samples giving each U statistic.
+
+    U is the number of pairs where the element of the first sample, of size
+    ``n``, is greater than the element of the second one, of size ``m``.
+
+    """
+    previous = [numpy.ones(1)] * (m + 1)
+    for i in range(1, n + 1):
+        current = [numpy.ones(1)]
+        for j in range(1, m + 1):
+            counts = numpy.zeros(i * j + 1)
+            # The greatest element is in the first sample
+            counts[j:] += previous[j]
+            # The greatest element is in the second sample
+            counts[:len(current[j - 1])] += current[j - 1]
+            current.append(counts)
+        previous = current
+    return previous[m]
+
+
+def slower_probability(old, new):
+    """Get the p-value of the Mann-Whitney test of ``new`` being slower."""
+    u = sum(
+        (new_time > old_time) + (new_time == old_time) / 2
+        for new_time in new for old_time in old)
+    counts = u_distribution(len(new), len(old))
+    return counts[math.ceil(u):].sum() / counts.sum()
+
+
+def compare(old, new):
+    """Print the tests significantly slower in ``new`` than in ``old``."""
+    print('Comparing %s with %s' % (old['renderer'], new['renderer']))
+    ratios = []
+    slowdowns = []
+    for test_id, new_times in sorted(new['tests'].items()):
+        old_times = old['tests'].get(test_id)
+        if not old_times:
+            continue
+        ratio = numpy.median(new_times) / numpy.median(old_times)
+        ratios.append(ratio)
+        if ratio > THRESHOLD:
+            probability = slower_probability(old_times, new_times)
+            if probability < ALPHA:
+                slowdowns.append((test_id, ratio, probability))
+    if not ratios:
+        print('No common tests')
+        return
+
+    # Confidence interval of the geometric mean of the ratios, bootstrapped
+    # with a fixed seed to give the same results for the same files
+    logs = numpy.log(ratios)
+    samples = numpy.random.RandomState(0).choice(
+        logs, (1000, len(logs))).mean(axis=1)
+    low, high = numpy.exp(numpy.percentile(
+        samples, (100 * ALPHA / 2, 100 * (1 - ALPHA / 2))))
+    print('Speed ratio: %.3f (%.3f - %.3f) on %d tests' % (
+        numpy.exp(logs.mean()), low, high, len(ratios)))
+    print('Pages/sec: %.2f -> %.2f' % (
+        old['pages_per_second'], new['pages_per_second']))
+    for key in ('p50', 'p95', 'p99'):
+        print('%s: %.1f ms -> %.1f ms' % (
+            key, 1000 * old['latency'][key], 1000 * new['latency'][key]))
+    if low > 1:
+        print('\nThe new version is significantly slower')
+
+    if slowdowns:
+        print('\nSlower tests:')
+        for test_id, ratio, probability in sorted(
+                slowdowns, key=lambda slowdown: slowdown[1], reverse=True):
+            print('%s  x%.2f  (p=%.4f)' % (test_id, ratio, probability))
+    return bool(slowdowns) or low > 1
+
+
+if options.compare:
+    old, new = (read_benchmark(name) for name in options.compare)
+    sys.exit(1 if compare(old, new) else 0)
+
+print('Benchmarking version %s' % VERSION)
+
+for suite in options.suites or os.listdir(BASE_PATH):
+    add_suite(suite)
+
+tests = list(sample_tests(options.sample))
+print('%d tests, %d warmup and %d timed renderings each' % (
+    len(tests), options.warmup, options.repeat))
+
+# Crashing tests are removed from the sample
+crashes = set()
+for _ in range(options.warmup):
+    for test_id, filename in tests:
+        if test_id not in crashes:
+            try:
+                render(filename)
+            except Exception:
+                crashes.add(test_id)
+    print('w', end='')
+    sys.stdout.flush()
+
+times = {test_id: [] for test_id, _ in tests}
+pages = {}
+reset_peak_rss()
+for _ in range(options.repeat):
+    for test_id, filename in tests:
+        if test_id in crashes:
+            continue
+        start = time.perf_counter()
+        try:
+            pages[test_id] = render(filename)
+        except Exception:
+            crashes.add(test_id)
+            continue
+        times[test_id].append(time.perf_counter() - start)
+    print('.', end='')
+    sys.stdout.flush()
+print()
+
+for test_id in crashes:
+    print('Crash: %s' % test_id)
+    times.pop(test_id)
+total = sum(sum(test_times) for test_times in times.values())
+pages = sum(pages[test_id] * len(times[test_id]) for test_id in times)
+medians = [numpy.median(test_times) for test_times in times.values()]
+p50, p95, p99 = numpy.percentile(medians, (50, 95, 99))
+results = {
+    'version': VERSION, 'renderer': RENDERER,
+    'date': str(datetime(*datetime.utcnow().timetuple()[:6])),
+    'repeat': options.repeat, 'warmup': options.warmup,
+    'pages_per_second': pages / total,
+    'latency': {'p50': p50, 'p95': p95, 'p99': p99},
+    'rss': peak_rss(), 'tests': times}
+
+os.makedirs(os.path.dirname(benchmark_filename(VERSION)), exist_ok=True)
+with open(benchmark_filename(VERSION), 'w') as fd:
+    json.dump(results, fd, indent=2, sort_keys=True)
+
+print('Pages/sec: %.2f' % results['pages_per_second'])
+for key, value in sorted(results['latency'].items()):
+    print('%s: %.1f ms' % (key, 1000 * value))
+print('Peak memory: %.1f MiB' % (results['rss'] / 1024))
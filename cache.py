@@ -0,0 +1,169 @@
+"""
+weasysuite.cache
+----------------
+
+Caches keeping rendered pages in memory and on disk, and caches of the
+resources used to render tests.
+
+:copyright: Copyright 2011-2012 Simon Sapin, 2013-2016 Kozea
+:license: BSD, see LICENSE for details.
+
+"""
+
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+
+class LRUCache:
+    """A thread-safe mapping keeping the ``size`` last used items."""
+
+    def __init__(self, size=128):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+
+class RenderCache:
+    """Rendered documents stored on disk, with the last used kept in memory.
+
+    Keys must identify the content of the rendered documents, cached items
+    are never invalidated. Information about documents, such as the sizes of
+    their pages, is stored when they're laid out, as JSON-serializable
+    objects. Pages are stored as PNG images when they're rasterized. Items
+    are stored on disk in ``folder``.
+
+    """
+    def __init__(self, folder, size=128):
+        self.folder = folder
+        self.memory = LRUCache(size)
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], key)
+
+    def _write(self, filename, data):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(filename))
+        with os.fdopen(fd, 'wb') as fd:
+            fd.write(data)
+        # Files may be stored at the same time by other threads or processes
+        os.replace(temp_filename, filename)
+
+    def get(self, key):
+        """Get ``(info, mtime)`` for ``key``, or ``None`` if missing."""
+        item = self.memory.get(key)
+        if item is None:
+            filename = os.path.join(self._path(key), 'info.json')
+            try:
+                with open(filename) as fd:
+                    item = json.load(fd), os.path.getmtime(filename)
+            except (OSError, ValueError):
+                return None
+            self.memory[key] = item
+        return item
+
+    def set(self, key, info):
+        """Store the information ``info`` about the document of ``key``."""
+        filename = os.path.join(self._path(key), 'info.json')
+        self._write(filename, json.dumps(info).encode())
+        self.memory[key] = info, os.path.getmtime(filename)
+
+    def get_page(self, key, page):
+        """Get the PNG image of a page, or ``None`` if it's missing."""
+        png = self.memory.get((key, page))
+        if png is None:
+            try:
+                with open(os.path.join(
+                        self._path(key), '%d.png' % page), 'rb') as fd:
+                    png = fd.read()
+            except OSError:
+                return None
+            self.memory[key, page] = png
+        return png
+
+    def set_page(self, key, page, png):
+        """Store the PNG image of a page."""
+        self._write(os.path.join(self._path(key), '%d.png' % page), png)
+        self.memory[key, page] = png
+
+
+def _file_key(path):
+    """Get a key for a local file, ``None`` if it's missing."""
+    try:
+        return path, os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class CachedFetcher:
+    """A URL fetcher keeping the ``size`` last fetched local files.
+
+    Resources are fetched by ``fetcher`` and keyed by their path and their
+    modification time.
+
+    """
+    def __init__(self, fetcher, size=256):
+        self.fetcher = fetcher
+        self.resources = LRUCache(size)
+
+    def __call__(self, url):
+        key = None
+        if url.startswith('file:'):
+            key = _file_key(url2pathname(urlparse(url).path))
+        if key is None:
+            return self.fetcher(url)
+        resource = self.resources.get(key)
+        if resource is None:
+            resource = self.fetcher(url)
+            if 'file_obj' in resource:
+                with resource.pop('file_obj') as fd:
+                    resource['string'] = fd.read()
+            self.resources[key] = resource
+        return dict(resource)
+
+
+class CachedStylesheets:
+    """Stylesheets parsed by ``parse(filename)``, kept for later renders."""
+
+    def __init__(self, parse, size=64):
+        self.parse = parse
+        self.stylesheets = LRUCache(size)
+
+    def get(self, filename):
+        key = _file_key(os.path.abspath(filename))
+        stylesheet = self.stylesheets.get(key)
+        if stylesheet is None:
+            stylesheet = self.parse(filename)
+            if key is not None:
+                self.stylesheets[key] = stylesheet
+        return stylesheet
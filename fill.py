@@ -6,56 +6,138 @@ weasysuite.fill
 A script filling the results of tests by comparing output PNG files from
 different versions.
 
+All the renderings are compared first, in parallel, then the results of each
+suite are written at once. Results of tests whose rendering has not changed
+are carried forward, ignoring the pixels found unstable by
+``generate.py --flaky``, tests needing DOM or scripts are not applicable, and
+other tests need to be reviewed. Results are also given to the other
+formats of the tests, when they're rendered like the main format.
+
 :copyright: Copyright 2011-2012 Simon Sapin, 2013-2016 Kozea
 :license: BSD, see LICENSE for details.
 
 """
 
+import argparse
 import os
 import sys
-import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from images import fuzzy_equal, merge_masks, png_pixels
 from web import (
-    BASE_PATH, FOLDER, OUTPUT_FOLDER, SUITES, VERSION, add_suite, options,
-    save_test)
+    BASE_PATH, FOLDER, STORE, SUITES, VERSION, add_suite, file_hash,
+    format_key, parser, read_manifest, read_mask, save_tests, test_image)
+
 
+options = argparse.ArgumentParser(parents=[parser]).parse_args()
 
 versions = sorted(os.listdir(os.path.join(FOLDER, 'results')))
 OLD_VERSION = versions[versions.index(VERSION) - 1]
 
 print('Testing version {} from {}'.format(VERSION, OLD_VERSION))
 
-print('\nI\'M GOING TO OVERWRITE TEST RESULTS IN 10 SECONDS!\n')
-for i in range(10):
-    print(10 - i, end=' ')
-    sys.stdout.flush()
-    time.sleep(1)
-
 for suite in options.suites or os.listdir(BASE_PATH):
     add_suite(suite)
 
-for suite_name, suite in SUITES.items():
-    print('\n\n\n## {} ##\n'.format(suite['name']))
-    for name, test in suite['results'][OLD_VERSION].items():
-        image_filename = os.path.join(OUTPUT_FOLDER, name + '.png')
-        old_image_filename = image_filename.replace(
-            '/%s/' % VERSION, '/%s/' % OLD_VERSION)
-        flags = test['flags'] or []
-        if test['result'] == 'na' or (
-                os.path.exists(old_image_filename) and
-                os.path.exists(image_filename) and
-                open(image_filename, 'rb').read() ==
-                open(old_image_filename, 'rb').read() and
-                test['result'] != '?'):
-            test['date'] = datetime(*datetime.utcnow().timetuple()[:6])
-            save_test(suite_name, test)
-            print('.', end='')
-        elif 'dom' in flags or 'script' in flags:
-            test['date'] = datetime(*datetime.utcnow().timetuple()[:6])
-            test['result'] = 'na'
-            save_test(suite_name, test)
-            print('n', end='')
-        else:
-            print('!', end='')
-        sys.stdout.flush()
+MANIFEST = read_manifest(VERSION)
+OLD_MANIFEST = read_manifest(OLD_VERSION)
+
+
+def same_images(name):
+    """Check whether the rendering of a test has changed.
+
+    Hashes stored in the manifests are compared first, then PNG files are
+    compared when tolerated differences are set, or when some pixels of the
+    test are unstable in one of the versions. Unstable pixels are ignored.
+
+    """
+    entry = MANIFEST['tests'].get(name, {})
+    old_entry = OLD_MANIFEST['tests'].get(name, {})
+    image_filename = test_image(VERSION, name, MANIFEST)
+    old_image_filename = test_image(OLD_VERSION, name, OLD_MANIFEST)
+    for key in ('pixels', 'png'):
+        if key in entry and key in old_entry:
+            if entry[key] == old_entry[key]:
+                return True
+            break
+    else:
+        if not (image_filename and old_image_filename):
+            return False
+        if file_hash(image_filename) == file_hash(old_image_filename):
+            return True
+    masks = [
+        mask for mask in (
+            read_mask(VERSION, name), read_mask(OLD_VERSION, name))
+        if mask is not None]
+    if options.fuzz_difference or options.fuzz_pixels or masks:
+        if image_filename and old_image_filename:
+            return fuzzy_equal(
+                png_pixels(image_filename), png_pixels(old_image_filename),
+                options.fuzz_difference, options.fuzz_pixels,
+                merge_masks(masks) if masks else None)
+    return False
+
+
+def decide(name, result, flags):
+    """Get the new result of a test, ``None`` if it has to be reviewed."""
+    if result == 'na' or (result != '?' and same_images(name)):
+        return result
+    elif 'dom' in flags or 'script' in flags:
+        return 'na'
+
+
+def same_formats(suite_name, name):
+    """Get the other formats where a test is rendered like in the main one."""
+    pixels = MANIFEST['tests'].get(name, {}).get('pixels')
+    return [
+        format for format in SUITES[suite_name]['formats']
+        if format != SUITES[suite_name]['format'] and pixels is not None and
+        MANIFEST['tests'].get(format_key(suite_name, name, format), {}).get(
+            'pixels') == pixels]
+
+
+SYMBOLS = {'carried': '.', 'na': 'n', 'review': '!'}
+totals = dict.fromkeys(SYMBOLS, 0)
+date = datetime(*datetime.utcnow().timetuple()[:6])
+
+with ThreadPoolExecutor(options.jobs or os.cpu_count()) as executor:
+    for suite_name, suite in sorted(SUITES.items()):
+        print('\n\n\n## {} ##\n'.format(suite['name']))
+        tests = list(suite['results'][OLD_VERSION].items())
+        results = executor.map(lambda item: decide(
+            item[0], item[1]['result'], item[1]['flags'] or []), tests)
+
+        saved = []
+        counts = dict.fromkeys(SYMBOLS, 0)
+        for (name, test), result in zip(tests, results):
+            if result is None:
+                kind = 'review'
+            else:
+                kind = 'carried' if result == test['result'] else 'na'
+                saved.append({
+                    'test_id': name, 'result': result, 'date': date,
+                    'comment': test['comment'], 'revision': test['revision']})
+            counts[kind] += 1
+            print(SYMBOLS[kind], end='')
+            sys.stdout.flush()
+
+        # Write all the results of the suite at once
+        formats = {}
+        for test in saved:
+            for format in same_formats(suite_name, test['test_id']):
+                formats.setdefault(format, []).append(test)
+        if saved:
+            save_tests(suite_name, saved)
+            for format, format_tests in formats.items():
+                save_tests(suite_name, format_tests, format)
+            STORE.export(VERSION, suite_name)
+        print('\n\n{carried} carried forward, {na} newly not applicable, '
+              '{review} to review'.format(**counts))
+        for format, format_tests in sorted(formats.items()):
+            print('{} results given to {}'.format(len(format_tests), format))
+        for kind, count in counts.items():
+            totals[kind] += count
+
+print('\n\n\nTotal: {carried} carried forward, {na} newly not applicable, '
+      '{review} to review'.format(**totals))
@@ -5,79 +5,573 @@ weasysuite.generate
 
 A script generating PNG images for all tests.
 
+Tests can be shared between multiple machines, either with static shards
+(``--shard 2/4``) or with a queue of chunks of tests claimed by each
+machine (``--queue``) in a shared results folder. Each machine writes its
+images in its own folder, merged into the results of the version with
+``--merge``. Queue runs are named after the host and the process, an
+explicit ``--name`` is needed to resume them.
+
+PNG files are stored once in a blob store shared by all the versions,
+manifests of versions give the hashes of the images of their tests. Images
+stored in the folders of versions are moved to the blob store with
+``--pack``.
+
+Workers rendering tests can be replaced after a number of tests with
+``--max-tasks``, or when they use too much memory with ``--max-rss``. The
+peak and mean memory used by the tests of each chapter are reported.
+
+Tests are rendered in all the formats of their suite, the renderings of a
+test in its different formats being dispatched together to the workers.
+
+With ``--flaky RUNS``, each test is rendered RUNS times instead, and the
+tests whose renderings change are stored in the results of the version
+with the masks of their unstable pixels, ignored when results are filled.
+Masks are merged with the ones found by previous runs.
+
+With ``--profile``, tests are rendered with cProfile and the profiles of
+the tests of each chapter are aggregated in the results of the version.
+
 :copyright: Copyright 2011-2012 Simon Sapin, 2013-2016 Kozea
 :license: BSD, see LICENSE for details.
 
 """
 
+import argparse
+import json
 import logging
 import os
+import pstats
 import re
 import shutil
+import socket
 import sys
 import time
-import traceback
+from datetime import datetime
+from urllib.parse import urlparse
+from urllib.request import url2pathname
 
 from weasyprint import HTML
 
+from images import merge_masks, pixels_hash, surface_pixels, unstable_pixels
+from profiles import hot_functions, profile
 from web import (
-    BASE_PATH, OUTPUT_FOLDER, STYLESHEET, SUITES, VERSION, add_suite, options)
+    BASE_PATH, BLOBS, FOLDER, OUTPUT_FOLDER, RENDERER, STYLESHEET, SUITES,
+    URL_FETCHER, VERSION, add_suite, file_hash, find_file, format_key,
+    parser, read_flaky, read_manifest, read_mask, read_metrics,
+    render_pixels, test_image, write_flaky, write_manifest, write_mask,
+    write_metrics)
+from workers import make_pool, peak_rss, reset_peak_rss, serial
+
 
+parser = argparse.ArgumentParser(parents=[parser])
+parser.add_argument('-i', '--incremental', action='store_true')
+parser.add_argument('--shard', metavar='INDEX/NUMBER')
+parser.add_argument('--queue', action='store_true')
+parser.add_argument('--resume', action='store_true')
+parser.add_argument('--merge', action='store_true')
+parser.add_argument('--pack', action='store_true')
+parser.add_argument('--profile', action='store_true')
+parser.add_argument('--flaky', type=int, metavar='RUNS')
+parser.add_argument('--name')
+options = parser.parse_args()
+if options.queue and options.resume and not options.name:
+    parser.error('resuming a queue run needs its --name')
 
 logging.getLogger('weasyprint').setLevel(100)
 
+VERSION_FOLDER = os.path.dirname(OUTPUT_FOLDER)
+SHARDS_FOLDER = os.path.join(VERSION_FOLDER, 'shards')
+QUEUE_FOLDER = os.path.join(VERSION_FOLDER, 'queue')
+PROFILES_FOLDER = os.path.join(VERSION_FOLDER, 'profiles')
+CHUNK_SIZE = 100
+
+if options.shard:
+    SHARD, SHARDS = (int(number) for number in options.shard.split('/'))
+    NAME = 'shard-%d-of-%d' % (SHARD, SHARDS)
+elif options.queue:
+    # Runs on the same host must not share their folder and their chunks
+    NAME = options.name or '%s-%d' % (socket.gethostname(), os.getpid())
+else:
+    NAME = None
+OUTPUT = os.path.join(SHARDS_FOLDER, NAME) if NAME else OUTPUT_FOLDER
+if NAME:
+    PROFILES_FOLDER = os.path.join(PROFILES_FOLDER, NAME)
+CHECKPOINT = os.path.join(OUTPUT, 'checkpoint')
+
 print('Testing version %s' % VERSION)
+if NAME:
+    # Queue runs are resumed with this name
+    print('Run name: %s' % NAME)
+
+MANIFEST = read_manifest()
+METRICS = read_metrics()
 
-if os.path.exists(OUTPUT_FOLDER):
+if os.path.exists(OUTPUT_FOLDER) and not (
+        options.incremental or options.resume or options.merge or
+        options.pack or options.flaky or NAME):
     print('\nI\'M GOING TO REMOVE OLD TEST RESULTS IN 10 SECONDS!\n')
     for i in range(10):
         print(10 - i, end=' ')
         sys.stdout.flush()
         time.sleep(1)
     shutil.rmtree(OUTPUT_FOLDER)
+    MANIFEST['tests'] = {}
 
-os.makedirs(OUTPUT_FOLDER)
+os.makedirs(OUTPUT, exist_ok=True)
 
 for suite in options.suites or os.listdir(BASE_PATH):
     add_suite(suite)
 
 
-CRASHES = []
+def render_test(filename, image_filename):
+    """Render the test.
+
+    The PNG file is moved to the blob store. Return the paths of the files
+    read by WeasyPrint, the hashes of the PNG file and of its pixels, and
+    the metrics of the rendering.
+
+    """
+    paths = [filename]
+
+    def url_fetcher(url):
+        if url.startswith('file:'):
+            paths.append(url2pathname(urlparse(url).path))
+        return URL_FETCHER(url)
+
+    reset_peak_rss()
+    start = time.perf_counter()
+    html = HTML(filename, encoding='utf8', url_fetcher=url_fetcher)
+    parsed = time.perf_counter()
+    document = html.render(
+        stylesheets=[STYLESHEET], presentational_hints=True)
+    laid_out = time.perf_counter()
+    surface, _, _ = document.write_image_surface()
+    surface.write_to_png(image_filename)
+    encoded = time.perf_counter()
+    return {
+        'files': paths, 'png': BLOBS.add(image_filename),
+        'pixels': pixels_hash(surface_pixels(surface)),
+        'metrics': {
+            'parse': parsed - start, 'layout': laid_out - parsed,
+            'encode': encoded - laid_out, 'rss': peak_rss(),
+            'pages': len(document.pages)}}
 
-for suite_name, suite in SUITES.items():
-    print('\n\n\n## {} ##\n'.format(suite['name']))
-    for chapter_name, sections, test_number in suite['chapters']:
+
+def profile_test(filename, image_filename):
+    """Render the test with cProfile, saving the profile next to the PNG."""
+    result, stats = profile(render_test, filename, image_filename)
+    result['profile'] = image_filename + '.pstats'
+    stats.dump_stats(result['profile'])
+    return result
+
+
+def save_profiles(profiles):
+    """Save the profiles of each chapter, print their hottest functions."""
+    print('\n\n\nProfiles:')
+    for (suite_name, chapter_name), stats in sorted(profiles.items()):
+        folder = os.path.join(PROFILES_FOLDER, suite_name)
+        os.makedirs(folder, exist_ok=True)
+        filename = os.path.join(folder, '{}.pstats'.format(
+            re.sub('[^a-z0-9]+', '-', chapter_name.lower()).strip('-')))
+        stats.dump_stats(filename)
         print('\n# {} #'.format(re.sub('[\n ]+', ' ', chapter_name)))
-        for section_name, link, tests in sections:
+        print(filename)
+        for function in hot_functions(stats, 5):
+            print('{time:8.3f}s {calls:8d} {name}'.format(**function))
+
+
+def memory_summary(memory):
+    """Get the peak and mean RSS of the tests of each chapter, in kB."""
+    summary = {}
+    for (suite_name, chapter_name), rss in memory.items():
+        summary.setdefault(suite_name, {})[chapter_name] = {
+            'peak': max(rss), 'mean': sum(rss) / len(rss)}
+    return summary
+
+
+def print_memory(summary, recycled):
+    print('\n\n\nMemory:')
+    for suite_name, chapters in sorted(summary.items()):
+        print('\n## {} ##\n'.format(SUITES[suite_name]['name']))
+        for chapter_name, rss in chapters.items():
+            print('{:8.1f} MiB peak {:8.1f} MiB mean  {}'.format(
+                rss['peak'] / 1024, rss['mean'] / 1024,
+                re.sub('[\n ]+', ' ', chapter_name)))
+    if recycled:
+        print('\n%d workers recycled' % recycled)
+
+
+def list_tests():
+    """List the tests to render, in a deterministic order.
+
+    Each test is given once for each format, with the name of its rendering
+    in the manifest. Tests listed in multiple sections are only given once.
+
+    """
+    keys = set()
+    for suite_name, suite in sorted(SUITES.items()):
+        for chapter_name, sections, test_number in suite['chapters']:
+            for section_name, link, tests in sections:
+                for test in tests:
+                    for format in suite['formats']:
+                        key = format_key(suite_name, test['test_id'], format)
+                        filename = find_file(
+                            suite_name, test['test_id'], format)
+                        if filename and key not in keys:
+                            keys.add(key)
+                            yield (
+                                suite_name, chapter_name, section_name, key,
+                                filename, os.path.join(
+                                    OUTPUT, '{}.png'.format(key)))
+
+
+HASHES = {}
+
+
+def hashes(paths):
+    """Get the hashes of files, relative to the suites folder."""
+    files = {}
+    for path in paths:
+        path = os.path.relpath(os.path.join(BASE_PATH, path), BASE_PATH)
+        if path not in HASHES:
+            HASHES[path] = file_hash(os.path.join(BASE_PATH, path))
+        files[path] = HASHES[path]
+    return files
+
+
+def up_to_date(test_id):
+    """Check whether the PNG file of the test has to be generated again."""
+    entry = MANIFEST['tests'].get(test_id)
+    return bool(
+        entry and entry['status'] == 'done' and
+        entry.get('renderer') == RENDERER and
+        test_image(VERSION, test_id, MANIFEST) and
+        hashes(entry['files']) == entry['files'])
+
+
+def claim(chunk):
+    """Claim a chunk of tests in the queue, return whether it's claimed."""
+    filename = os.path.join(QUEUE_FOLDER, str(chunk))
+    try:
+        fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        if os.path.exists(filename + '.done'):
+            return False
+        # Chunks claimed by this machine are claimed again when resuming
+        with open(filename) as fd:
+            return options.resume and fd.read() == NAME
+    with os.fdopen(fd, 'w') as fd:
+        fd.write(NAME)
+    return True
+
+
+def batches(tests):
+    """Yield the lists of tests rendered by this machine."""
+    if options.queue:
+        os.makedirs(QUEUE_FOLDER, exist_ok=True)
+        for chunk, start in enumerate(range(0, len(tests), CHUNK_SIZE)):
+            if claim(chunk):
+                yield tests[start:start + CHUNK_SIZE]
+                filename = os.path.join(QUEUE_FOLDER, '%d.done' % chunk)
+                with open(filename, 'w') as fd:
+                    fd.write(NAME)
+    elif options.shard:
+        yield [
+            test for chunk, start in enumerate(
+                range(0, len(tests), CHUNK_SIZE))
+            if chunk % SHARDS == SHARD - 1
+            for test in tests[start:start + CHUNK_SIZE]]
+    else:
+        yield tests
+
+
+class Progress:
+    """Print the progress of a run, section by section."""
+
+    def __init__(self):
+        self.suite = self.chapter = self.section = None
+
+    def start(self, suite_name, chapter_name, section_name):
+        if (suite_name, chapter_name, section_name) != (
+                self.suite, self.chapter, self.section):
+            self.end()
+        if suite_name != self.suite:
+            print('\n\n\n## {} ##\n'.format(SUITES[suite_name]['name']))
+            self.suite, self.chapter = suite_name, None
+        if chapter_name != self.chapter:
+            print('\n# {} #'.format(re.sub('[\n ]+', ' ', chapter_name)))
+            self.chapter = None
+        if section_name != self.section:
             print(section_name, end=' ')
-            for test in tests:
-                test_id = test['test_id']
-                image_filename = os.path.join(
-                    OUTPUT_FOLDER, '{}.png'.format(test_id))
-                filenames = [
-                    filename for filename in os.listdir(suite['path'])
-                    if os.path.splitext(filename.lower())[0] == test_id]
-                if filenames:
-                    filename = os.path.join(suite['path'], filenames[0])
-                    try:
-                        document = HTML(filename, encoding='utf8').write_png(
-                            image_filename, stylesheets=[STYLESHEET],
-                            presentational_hints=True)
-                    except KeyboardInterrupt as error:
-                        raise error
-                    except:
-                        print('C', end='')
-                        crash_filename = '{}.txt'.format(image_filename)
-                        CRASHES.append('%s - %s - %s - %s' % (
-                            suite_name, chapter_name, section_name, test_id))
-                        with open(crash_filename, 'w') as fd:
-                            fd.write(traceback.format_exc())
-                    else:
-                        print('.', end='')
-                    sys.stdout.flush()
+        self.chapter, self.section = chapter_name, section_name
+
+    def end(self):
+        if self.section is not None:
             print()
+            self.section = None
+
+
+def print_crashes(crashes, timeouts):
+    if crashes:
+        print('\n\n\nCrashes:')
+        for crash in crashes:
+            print(crash)
+
+    if timeouts:
+        print('\n\n\nTimeouts:')
+        for timeout in timeouts:
+            print(timeout)
+
+
+def merge():
+    """Merge the images, manifests and metrics of finished shards."""
+    places = {test[3]: test[:3] for test in list_tests()}
+    crashes, timeouts = [], []
+    if not os.path.isdir(SHARDS_FOLDER):
+        print('No shard to merge')
+        return
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+    for name in sorted(os.listdir(SHARDS_FOLDER)):
+        folder = os.path.join(SHARDS_FOLDER, name)
+        if os.path.exists(os.path.join(folder, 'checkpoint')):
+            print('Shard %s is not finished, skipping it' % name)
+            continue
+        manifest = read_manifest(folder=folder)
+        for test_id, entry in manifest['tests'].items():
+            MANIFEST['tests'][test_id] = entry
+            for filename in ('{}.png', '{}.png.txt'):
+                filename = filename.format(test_id)
+                merged_filename = os.path.join(OUTPUT_FOLDER, filename)
+                os.makedirs(os.path.dirname(merged_filename), exist_ok=True)
+                if os.path.exists(merged_filename):
+                    os.remove(merged_filename)
+                if os.path.exists(os.path.join(folder, filename)):
+                    os.replace(
+                        os.path.join(folder, filename), merged_filename)
+            if entry['status'] != 'done':
+                crash = ' - '.join(
+                    places.get(test_id, ('?', '?', '?')) + (test_id,))
+                if entry['status'] == 'timeout':
+                    timeouts.append(crash)
+                else:
+                    crashes.append(crash)
+        MANIFEST['runs'].extend(manifest['runs'])
+        for suite_name, suite_metrics in read_metrics(folder=folder).items():
+            METRICS.setdefault(suite_name, {}).update(suite_metrics)
+        shutil.rmtree(folder)
+        print('Shard %s merged' % name)
+    write_manifest(MANIFEST)
+    write_metrics(METRICS)
+    if not os.listdir(SHARDS_FOLDER):
+        os.rmdir(SHARDS_FOLDER)
+        shutil.rmtree(QUEUE_FOLDER, ignore_errors=True)
+    print_crashes(crashes, timeouts)
+
+
+def pack():
+    """Move the images of all the versions to the blob store."""
+    for version in sorted(os.listdir(os.path.join(FOLDER, 'results'))):
+        folder = os.path.join(FOLDER, 'results', version, 'png')
+        if not os.path.isdir(folder):
+            continue
+        manifest = read_manifest(version)
+        images = {}
+        for name in os.listdir(folder):
+            if name.endswith('.png'):
+                filename = os.path.join(folder, name)
+                images[filename] = file_hash(filename)
+                manifest['tests'].setdefault(
+                    name[:-4], {'status': 'done'})['png'] = images[filename]
+        # Images are moved once the manifest is saved, so that they can
+        # always be found
+        write_manifest(manifest, version)
+        for filename, digest in images.items():
+            BLOBS.add(filename, digest)
+        print('%s: %d images packed' % (version, len(images)))
+
+
+def flaky():
+    """Render each test multiple times, save the tests changing each time.
+
+    The renderings of a test are dispatched together to the workers. Tests
+    rendered less than twice, because of crashes, are ignored.
+
+    """
+    runs = options.flaky
+    tests = list(list_tests())
+    tasks = [(test[4],) for test in tests for _ in range(runs)]
+    pool = make_pool(render_pixels, options)
+    results = pool.imap(tasks) if pool else serial(render_pixels, tasks)
+    flaky_tests = read_flaky()
+    progress = Progress()
+    found = []
+    for suite_name, chapter_name, section_name, test_id, _, _ in tests:
+        progress.start(suite_name, chapter_name, section_name)
+        renderings = [
+            value for _, status, value in
+            (next(results) for _ in range(runs)) if status == 'done']
+        if len(renderings) < 2:
+            print('C', end='')
+            continue
+        mask = unstable_pixels(renderings)
+        previous_mask = read_mask(VERSION, test_id)
+        if previous_mask is not None:
+            mask = merge_masks((mask, previous_mask))
+        if mask.any():
+            write_mask(mask, VERSION, test_id)
+            runs_before = flaky_tests.get(test_id, {}).get('runs', 0)
+            flaky_tests[test_id] = {
+                'runs': runs_before + len(renderings),
+                'pixels': int(mask.sum())}
+            found.append('%s - %s - %s - %s' % (
+                suite_name, chapter_name, section_name, test_id))
+            print('F', end='')
+        else:
+            print('.', end='')
+        sys.stdout.flush()
+    progress.end()
+    write_flaky(flaky_tests)
+    if found:
+        print('\n\n\nNondeterministic:')
+        for test in found:
+            print(test)
+
+
+if options.pack:
+    pack()
+    sys.exit()
+
+if options.flaky:
+    flaky()
+    sys.exit()
+
+if options.merge:
+    merge()
+    sys.exit()
+
+# Manifest and metrics of this run, stored in the results of the version
+# or in the folder of the shard
+if NAME:
+    OUTPUT_MANIFEST = read_manifest(folder=OUTPUT)
+    OUTPUT_METRICS = read_metrics(folder=OUTPUT)
+else:
+    OUTPUT_MANIFEST = MANIFEST
+    OUTPUT_METRICS = METRICS
+
+CRASHES = []
+TIMEOUTS = []
+RUN = {
+    'date': str(datetime(*datetime.utcnow().timetuple()[:6])),
+    'renderer': RENDERER, 'rendered': [], 'skipped': 0}
+if NAME:
+    RUN['shard'] = NAME
+OUTPUT_MANIFEST['runs'].append(RUN)
+
+# Tests rendered by an interrupted run are saved in the checkpoint
+checkpointed = set()
+if options.resume and os.path.exists(CHECKPOINT):
+    with open(CHECKPOINT) as fd:
+        for line in fd:
+            try:
+                test_id, suite_name, entry, metrics = json.loads(line)
+            except ValueError:
+                # Last line written when the run was killed
+                continue
+            checkpointed.add(test_id)
+            OUTPUT_MANIFEST['tests'][test_id] = entry
+            if metrics:
+                OUTPUT_METRICS.setdefault(suite_name, {})[test_id] = metrics
+
+# Profiles and memory used by the tests are aggregated by chapter
+PROFILES = {}
+MEMORY = {}
+render = profile_test if options.profile else render_test
+
+pool = make_pool(render, options)
+
+progress = Progress()
+checkpoint = open(CHECKPOINT, 'a' if options.resume else 'w')
+ALL_TESTS = list(list_tests())
+for folder in {os.path.dirname(test[-1]) for test in ALL_TESTS}:
+    os.makedirs(folder, exist_ok=True)
+try:
+    for tests in batches(ALL_TESTS):
+        skipped = checkpointed | {
+            test[3] for test in tests
+            if options.incremental and up_to_date(test[3])}
+        tasks = [test[-2:] for test in tests if test[3] not in skipped]
+        results = pool.imap(tasks) if pool else serial(render, tasks)
+        for test in tests:
+            suite_name, chapter_name, section_name, test_id, filename, \
+                image_filename = test
+            progress.start(suite_name, chapter_name, section_name)
+
+            if test_id in skipped:
+                RUN['skipped'] += 1
+                print('-', end='')
+                continue
+
+            _, status, value = next(results)
+            entry = OUTPUT_MANIFEST['tests'][test_id] = {
+                'status': status, 'renderer': RENDERER, 'date': RUN['date'],
+                'files': hashes([filename])}
+            suite_metrics = OUTPUT_METRICS.setdefault(suite_name, {})
+            suite_metrics.pop(test_id, None)
+            if status == 'done':
+                suite_metrics[test_id] = value.pop('metrics')
+                MEMORY.setdefault((suite_name, chapter_name), []).append(
+                    suite_metrics[test_id]['rss'])
+                if 'profile' in value:
+                    profile_filename = value.pop('profile')
+                    stats = PROFILES.get((suite_name, chapter_name))
+                    if stats is None:
+                        PROFILES[suite_name, chapter_name] = pstats.Stats(
+                            profile_filename)
+                    else:
+                        stats.add(profile_filename)
+                    os.remove(profile_filename)
+                entry.update(value)
+                entry['files'] = hashes(value['files'])
+            RUN['rendered'].append(test_id)
+            checkpoint.write(json.dumps((
+                test_id, suite_name, entry,
+                suite_metrics.get(test_id))) + '\n')
+            checkpoint.flush()
+
+            # Remove what's left from a previous run, including images
+            # stored before images were stored by hash
+            stale_filenames = [image_filename]
+            if status == 'done':
+                stale_filenames.append(image_filename + '.txt')
+            for stale_filename in stale_filenames:
+                if os.path.exists(stale_filename):
+                    os.remove(stale_filename)
+
+            if status == 'done':
+                print('.', end='')
+            else:
+                print('T' if status == 'timeout' else 'C', end='')
+                crash = '%s - %s - %s - %s' % (
+                    suite_name, chapter_name, section_name, test_id)
+                (TIMEOUTS if status == 'timeout' else CRASHES).append(crash)
+                with open('{}.txt'.format(image_filename), 'w') as fd:
+                    fd.write(value)
+            sys.stdout.flush()
+    progress.end()
+finally:
+    checkpoint.close()
+    RUN['memory'] = memory_summary(MEMORY)
+    write_manifest(OUTPUT_MANIFEST, folder=OUTPUT)
+    write_metrics(OUTPUT_METRICS, folder=OUTPUT if NAME else None)
+
+# The run is finished and can't be resumed anymore
+os.remove(CHECKPOINT)
+
+if PROFILES:
+    save_profiles(PROFILES)
+
+if MEMORY:
+    print_memory(RUN['memory'], pool.recycled if pool else 0)
 
-if CRASHES:
-    print('\n\n\nCrashes:')
-    for crash in CRASHES:
-        print(crash)
+print_crashes(CRASHES, TIMEOUTS)
@@ -0,0 +1,106 @@
+"""
+weasysuite.images
+-----------------
+
+Helpers reading rendered pages as arrays of pixels and comparing them.
+
+:copyright: Copyright 2011-2012 Simon Sapin, 2013-2016 Kozea
+:license: BSD, see LICENSE for details.
+
+"""
+
+import hashlib
+import io
+
+import cairocffi
+import numpy
+
+
+def surface_pixels(surface):
+    """Get the pixels of a cairo image surface.
+
+    The returned array has a ``(height, width, 4)`` shape, with the
+    channels stored in the native-endian ARGB32 order of cairo.
+
+    """
+    surface.flush()
+    width, height = surface.get_width(), surface.get_height()
+    pixels = numpy.frombuffer(bytes(surface.get_data()), numpy.uint8)
+    pixels = pixels.reshape(height, surface.get_stride())[:, :width * 4]
+    return pixels.reshape(height, width, 4).copy()
+
+
+def png_pixels(png):
+    """Get the pixels of a PNG image, given as a filename or as bytes."""
+    if isinstance(png, bytes):
+        png = io.BytesIO(png)
+    return surface_pixels(cairocffi.ImageSurface.create_from_png(png))
+
+
+def pixels_hash(pixels):
+    """Get a hash of the size and the values of pixels."""
+    sha1 = hashlib.sha1(str(pixels.shape).encode())
+    sha1.update(numpy.ascontiguousarray(pixels).data)
+    return sha1.hexdigest()
+
+
+def pad(arrays):
+    """Pad arrays of pixels or masks with zeros to give them the same size."""
+    height = max(array.shape[0] for array in arrays)
+    width = max(array.shape[1] for array in arrays)
+    return [
+        numpy.pad(array, (
+            (0, height - array.shape[0]), (0, width - array.shape[1])) +
+            ((0, 0),) * (array.ndim - 2))
+        for array in arrays]
+
+
+def unstable_pixels(renderings):
+    """Get the mask of the pixels changing between renderings of a test.
+
+    ``renderings`` is a list of arrays of pixels. Return a ``(height,
+    width)`` array of booleans, true for pixels whose channels have a
+    non-zero variance. Renderings with different sizes are padded with
+    transparent pixels.
+
+    """
+    pixels = numpy.stack(pad(renderings))
+    return pixels.var(axis=0).max(axis=2) > 0
+
+
+def merge_masks(masks):
+    """Get the mask of the pixels set in at least one of ``masks``."""
+    return numpy.logical_or.reduce(pad(masks))
+
+
+def difference(pixels, other_pixels, mask=None):
+    """Compare two arrays of pixels.
+
+    Return the maximum difference between two channels of a pixel, and the
+    number of different pixels. Arrays with different sizes are compared as
+    if they were padded with transparent pixels. Pixels set in ``mask`` are
+    ignored.
+
+    """
+    if pixels.shape != other_pixels.shape:
+        pixels, other_pixels = pad((pixels, other_pixels))
+    delta = numpy.abs(pixels.astype(numpy.int16) - other_pixels).max(axis=2)
+    if mask is not None:
+        height, width = delta.shape
+        mask = pad((mask[:height, :width], delta))[0]
+        delta[mask] = 0
+    return int(delta.max(initial=0)), int(numpy.count_nonzero(delta))
+
+
+def fuzzy_equal(pixels, other_pixels, max_difference=0, max_pixels=0,
+                mask=None):
+    """Check whether two arrays of pixels are equal within a tolerance.
+
+    Pixels are considered as equal when at most ``max_pixels`` pixels are
+    different, each channel of these pixels having a difference lower than
+    or equal to ``max_difference``. Pixels set in ``mask`` are ignored.
+
+    """
+    maximum, number = difference(pixels, other_pixels, mask)
+    return number == 0 or (
+        maximum <= max_difference and number <= max_pixels)
@@ -0,0 +1,51 @@
+"""
+weasysuite.profiles
+-------------------
+
+Helpers profiling renderings with cProfile and summarizing the profiles.
+
+:copyright: Copyright 2011-2012 Simon Sapin, 2013-2016 Kozea
+:license: BSD, see LICENSE for details.
+
+"""
+
+import cProfile
+import os
+import pstats
+
+
+def profile(function, *args, **kwargs):
+    """Call ``function`` with cProfile, return its result and the profile."""
+    profiler = cProfile.Profile()
+    result = profiler.runcall(function, *args, **kwargs)
+    profiler.create_stats()
+    return result, pstats.Stats(profiler)
+
+
+def function_name(filename, line, name):
+    """Get a short name for a profiled function."""
+    if filename == '~':
+        # Built-in function
+        return name
+    parts = filename.split(os.sep)
+    if 'site-packages' in parts:
+        parts = parts[parts.index('site-packages') + 1:]
+    else:
+        parts = parts[-2:]
+    return '%s:%d(%s)' % ('/'.join(parts), line, name)
+
+
+def hot_functions(stats, number=20):
+    """Get the ``number`` functions where most of the time is spent.
+
+    Return a list of dicts with the name of the function, its number of
+    calls, the time spent in the function and the time spent in the function
+    and the functions it calls.
+
+    """
+    functions = [{
+        'name': function_name(*function), 'calls': calls, 'time': time,
+        'cumulative': cumulative,
+    } for function, (_, calls, time, cumulative, _) in stats.stats.items()]
+    functions.sort(key=lambda function: function['time'], reverse=True)
+    return functions[:number]
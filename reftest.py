@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+weasysuite.reftest
+------------------
+
+A script filling the results of reftests by comparing the rendering of
+tests with the rendering of their references.
+
+:copyright: Copyright 2011-2012 Simon Sapin, 2013-2016 Kozea
+:license: BSD, see LICENSE for details.
+
+"""
+
+import argparse
+import logging
+import os
+import sys
+from datetime import datetime
+
+from images import fuzzy_equal
+from web import (
+    BASE_PATH, STORE, SUITES, VERSION, add_suite, find_file, parser,
+    render_pixels, save_tests)
+from workers import make_pool, serial
+
+
+options = argparse.ArgumentParser(parents=[parser]).parse_args()
+
+logging.getLogger('weasyprint').setLevel(100)
+
+print('Testing references of version %s' % VERSION)
+
+for suite in options.suites or os.listdir(BASE_PATH):
+    add_suite(suite)
+
+
+def run_reftest(filename, references, max_difference, max_pixels):
+    """Compare the test with its references, return its result.
+
+    The test passes when it matches one of its ``==`` references, if any,
+    and when it matches none of its ``!=`` references.
+
+    """
+    pixels = render_pixels(filename)
+    matches = {True: [], False: []}
+    for equal, reference in references:
+        matches[equal].append(fuzzy_equal(
+            pixels, render_pixels(reference), max_difference, max_pixels))
+    if matches[True] and not any(matches[True]):
+        return 'fail'
+    if any(matches[False]):
+        return 'fail'
+    return 'pass'
+
+
+def list_reftests():
+    """List the tests without result that can be compared to references.
+
+    Tests needing DOM or scripts are not applicable, they're left to
+    ``fill.py``.
+
+    """
+    for suite_name, suite in SUITES.items():
+        for test_id, test in suite['results'][VERSION].items():
+            if test['result'] not in ('?', 'unavailable'):
+                continue
+            if set(test['flags'] or ()) & {'dom', 'script'}:
+                continue
+            filename = find_file(suite_name, test_id)
+            references = [
+                (equal, find_file(suite_name, reference))
+                for equal, references in test.get('references', {}).items()
+                for reference in references]
+            if filename and references and all(
+                    reference for _, reference in references):
+                yield suite_name, test, filename, references
+
+
+def save(suite_name, tests):
+    """Save the results of the tests of a suite, writing its report once."""
+    if tests:
+        save_tests(suite_name, tests)
+        STORE.export(VERSION, suite_name)
+
+
+tests = list(list_reftests())
+tasks = [
+    (filename, references, options.fuzz_difference, options.fuzz_pixels)
+    for _, _, filename, references in tests]
+pool = make_pool(run_reftest, options)
+results = pool.imap(tasks) if pool else serial(run_reftest, tasks)
+
+current_suite = None
+saved = []
+for (suite_name, test, _, _), (_, status, value) in zip(tests, results):
+    if suite_name != current_suite:
+        save(current_suite, saved)
+        saved = []
+        print('\n\n\n## {} ##\n'.format(SUITES[suite_name]['name']))
+        current_suite = suite_name
+    if status == 'done':
+        test['result'] = value
+        test['date'] = datetime(*datetime.utcnow().timetuple()[:6])
+        saved.append(test)
+        print('.' if value == 'pass' else 'F', end='')
+    else:
+        print('C', end='')
+    sys.stdout.flush()
+save(current_suite, saved)
+print()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+weasysuite.regressions
+----------------------
+
+A script finding the version where tests started to fail.
+
+For each test, the last version where the test passed and the first later
+version where it failed are found in the results. The versions between them
+are bisected by comparing their renderings with the renderings of these two
+versions. Missing renderings are generated with WeasyPrint builds installed
+in other folders, given with ``--build VERSION=PATH``.
+
+:copyright: Copyright 2011-2012 Simon Sapin, 2013-2016 Kozea
+:license: BSD, see LICENSE for details.
+
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+from images import fuzzy_equal, png_pixels
+from web import (
+    BASE_PATH, FOLDER, STYLESHEET_SOURCE, SUITES, VERSION, add_suite,
+    find_file, parser, test_image)
+
+
+parser = argparse.ArgumentParser(parents=[parser])
+parser.add_argument('-t', '--test', action='append', dest='tests')
+parser.add_argument(
+    '--build', action='append', dest='builds', metavar='VERSION=PATH')
+options = parser.parse_args()
+
+BISECT_FOLDER = os.path.join(FOLDER, 'cache', 'bisect')
+BUILDS = dict(build.split('=', 1) for build in options.builds or ())
+
+# Rendering script run with the WeasyPrint build of a version, it can't use
+# the modules of WeasySuite that may be incompatible with this build
+RENDER_SCRIPT = '''
+import sys
+from weasyprint import CSS, HTML
+filename, stylesheet, target = sys.argv[1:]
+document = HTML(filename, encoding='utf8')
+stylesheets = [CSS(string=stylesheet)]
+try:
+    document.write_png(
+        target, stylesheets=stylesheets, presentational_hints=True)
+except TypeError:
+    # Old versions without presentational hints
+    document.write_png(target, stylesheets=stylesheets)
+'''
+
+
+def version_key(version):
+    """Get a key sorting versions in release order."""
+    return [int(number) for number in re.findall(r'\d+', version)], version
+
+
+def rendering(version, suite_name, test_id):
+    """Get the pixels of a test rendered by a version.
+
+    Images generated for the results of the version are used first, then
+    images generated by previous bisections. Tests are rendered if the build
+    of the version is given. Return ``None`` if no image is available.
+
+    """
+    filenames = [
+        test_image(version, test_id),
+        os.path.join(BISECT_FOLDER, version, test_id + '.png')]
+    for filename in filenames:
+        if filename and os.path.exists(filename):
+            return png_pixels(filename)
+    if version not in BUILDS:
+        return None
+
+    print('Rendering %s with %s' % (test_id, version))
+    os.makedirs(os.path.dirname(filenames[1]), exist_ok=True)
+    environment = dict(os.environ, PYTHONPATH=BUILDS[version])
+    try:
+        subprocess.run(
+            [sys.executable, '-c', RENDER_SCRIPT,
+             find_file(suite_name, test_id), STYLESHEET_SOURCE,
+             filenames[1] + '.tmp'],
+            env=environment, check=True, timeout=options.timeout,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as exception:
+        lines = exception.stderr.decode().strip().splitlines()
+        print(lines[-1] if lines else 'Crash (%d)' % exception.returncode)
+        return None
+    except subprocess.TimeoutExpired:
+        print('Timeout')
+        return None
+    os.replace(filenames[1] + '.tmp', filenames[1])
+    return png_pixels(filenames[1])
+
+
+def same_pixels(pixels, other_pixels):
+    return fuzzy_equal(
+        pixels, other_pixels, options.fuzz_difference, options.fuzz_pixels)
+
+
+def bisect(suite_name, test_id, versions):
+    """Find the versions between which a test started to fail.
+
+    The search starts from the last failure of the test, older breakages
+    fixed since then are ignored. Return the last good version and the first
+    bad version, ``None`` if the test never went from pass to fail.
+
+    """
+    results = SUITES[suite_name]['results']
+    verdicts = [results[version][test_id]['result'] for version in versions]
+    if 'fail' not in verdicts:
+        return None
+    last_fail = len(verdicts) - 1 - verdicts[::-1].index('fail')
+    if 'pass' not in verdicts[:last_fail]:
+        return None
+    good = last_fail - 1 - verdicts[last_fail - 1::-1].index('pass')
+    bad = verdicts.index('fail', good)
+
+    # Versions between good and bad have no result, compare their renderings
+    good_pixels = rendering(versions[good], suite_name, test_id)
+    bad_pixels = rendering(versions[bad], suite_name, test_id)
+    if good_pixels is None or bad_pixels is None:
+        return versions[good], versions[bad]
+    candidates = list(range(good + 1, bad))
+    while candidates:
+        middle = candidates[len(candidates) // 2]
+        pixels = rendering(versions[middle], suite_name, test_id)
+        if pixels is not None and same_pixels(pixels, good_pixels):
+            good = middle
+            candidates = [index for index in candidates if index > middle]
+        elif pixels is not None and same_pixels(pixels, bad_pixels):
+            bad = middle
+            candidates = [index for index in candidates if index < middle]
+        else:
+            # Missing or different rendering, skip this version
+            candidates.remove(middle)
+    return versions[good], versions[bad]
+
+
+def list_tests():
+    """List the tests to bisect, the given tests or the failing tests."""
+    for suite_name, suite in sorted(SUITES.items()):
+        for test_id, test in suite['results'][VERSION].items():
+            if options.tests:
+                if test_id in options.tests:
+                    yield suite_name, test_id
+            elif test['result'] == 'fail' and find_file(suite_name, test_id):
+                yield suite_name, test_id
+
+
+for suite in options.suites or os.listdir(BASE_PATH):
+    add_suite(suite)
+
+versions = sorted(
+    os.listdir(os.path.join(FOLDER, 'results')), key=version_key)
+if VERSION not in versions:
+    versions.append(VERSION)
+versions = versions[:versions.index(VERSION) + 1]
+
+print('Bisecting versions %s' % ', '.join(versions))
+
+for suite_name, test_id in list_tests():
+    found = bisect(suite_name, test_id, versions)
+    if found is None:
+        print('%s - %s: never passed before failing' % (suite_name, test_id))
+        continue
+    good, bad = found
+    if versions.index(bad) - versions.index(good) == 1:
+        print('%s - %s: broken in %s, passing in %s' % (
+            suite_name, test_id, bad, good))
+    else:
+        print('%s - %s: broken between %s and %s, renderings of the '
+              'versions in between are missing or different' % (
+                  suite_name, test_id, good, bad))
@@ -15,10 +15,14 @@ setup(
     author="Kozea",
     packages=find_packages(),
     include_package_data=True,
-    scripts=['web.py', 'fill.py', 'generate.py'],
+    py_modules=['cache', 'images', 'profiles', 'store', 'workers'],
+    scripts=[
+        'web.py', 'fill.py', 'generate.py', 'reftest.py', 'benchmark.py',
+        'regressions.py'],
     install_requires=[
         'flask',
         'lxml',
+        'numpy',
         'pygments',
         'weasyprint',
     ],
@@ -0,0 +1,432 @@
+"""
+weasysuite.store
+----------------
+
+A SQLite store for the results of the tests, imported from and exported to
+the implementation report files used by the W3C, the structures keeping
+these results in memory, and a store of the images generated for the tests.
+
+See http://wiki.csswg.org/test/implementation-report
+
+:copyright: Copyright 2011-2012 Simon Sapin, 2013-2016 Kozea
+:license: BSD, see LICENSE for details.
+
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS results (
+        version TEXT NOT NULL, suite TEXT NOT NULL, test_id TEXT NOT NULL,
+        format TEXT NOT NULL, name TEXT NOT NULL, revision TEXT,
+        result TEXT, comment TEXT, date TEXT, dirty INTEGER DEFAULT 0,
+        PRIMARY KEY (version, suite, test_id, format));
+    CREATE TABLE IF NOT EXISTS imports (
+        version TEXT NOT NULL, suite TEXT NOT NULL, mtime INTEGER,
+        size INTEGER, PRIMARY KEY (version, suite));
+'''
+
+
+def read_data(filename):
+    """Read an implementation report.
+
+    Yield ``(format, name, revision, result, comment, date)`` tuples,
+    ``revision`` and ``date`` being ``None`` when they're not given.
+
+    """
+    with open(filename) as fd:
+        lines = iter(fd.readlines())
+    included_revision = False
+    for line in lines:
+        if line.startswith('testname'):
+            included_revision = 'revision' in line
+            break
+    for line in lines:
+        line = line[:-1]
+        if '/' not in line or line.startswith('#'):
+            continue
+        revision = None
+        if included_revision:
+            if line.count('\t') < 3:
+                name, revision, result = line.split('\t', 2)
+                comment = ''
+            else:
+                name, revision, result, comment = line.split('\t', 3)
+        else:
+            name, result, comment = line.split('\t', 2)
+        if '\t' in comment:
+            comment, date = comment.split('\t')
+        else:
+            date = None
+        format, name = name.split('/', 1)
+        yield format, name, revision, result, comment, date or None
+
+
+def format_line(format, name, revision, result, comment, date):
+    """Format a line of an implementation report."""
+    line = ['/'.join((format, name)), result or '?', comment or '']
+    if revision is not None:
+        line.insert(1, revision)
+    if date:
+        line.append(date)
+    return '\t'.join(line) + '\n'
+
+
+class ResultStore:
+    """Results of the tests, for each version and suite.
+
+    Results are imported from the implementation reports stored in
+    ``folder/version/suite`` when these files change. Saved results are
+    marked as dirty until they're exported to these files.
+
+    """
+    def __init__(self, database, folder):
+        self.folder = folder
+        os.makedirs(os.path.dirname(database), exist_ok=True)
+        self.connection = sqlite3.connect(database, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self._lock = threading.RLock()
+        self._depth = 0
+
+    def filename(self, version, suite):
+        return os.path.join(self.folder, version, suite)
+
+    @contextmanager
+    def batch(self):
+        """Run all the writes done in this context in one transaction."""
+        with self._lock:
+            self._depth += 1
+            try:
+                yield
+            except BaseException:
+                self._depth -= 1
+                if not self._depth:
+                    self.connection.rollback()
+                raise
+            self._depth -= 1
+            if not self._depth:
+                self.connection.commit()
+
+    def stat(self, version, suite):
+        """Get the modification time and the size of a report, if any."""
+        try:
+            stat = os.stat(self.filename(version, suite))
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def sync(self, version, suite):
+        """Import the implementation report if it has changed.
+
+        Return ``False`` if there's no report for this version and suite.
+        Dirty results are kept.
+
+        """
+        stat = self.stat(version, suite)
+        with self.batch():
+            imported = self.connection.execute(
+                'SELECT mtime, size FROM imports '
+                'WHERE version = ? AND suite = ?', (version, suite)).fetchone()
+            if stat is None or imported == stat:
+                return stat is not None
+            self.connection.execute(
+                'DELETE FROM results '
+                'WHERE version = ? AND suite = ? AND NOT dirty',
+                (version, suite))
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO results (version, suite, test_id, '
+                'format, name, revision, result, comment, date) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                    (version, suite, os.path.splitext(name)[0], format, name,
+                     revision, result, comment, date)
+                    for format, name, revision, result, comment, date
+                    in read_data(self.filename(version, suite))))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO imports VALUES (?, ?, ?, ?)',
+                (version, suite) + stat)
+        return True
+
+    def results(self, version, suite, format):
+        """Yield ``(name, revision, result, comment, date)`` tuples."""
+        with self._lock:
+            return self.connection.execute(
+                'SELECT name, revision, result, comment, date FROM results '
+                'WHERE version = ? AND suite = ? AND format = ? '
+                'ORDER BY rowid', (version, suite, format)).fetchall()
+
+    def save(self, version, suite, format, test_id, result, comment, date,
+             revision=None):
+        """Save the result of a test, return ``False`` if it's unknown."""
+        with self.batch():
+            cursor = self.connection.execute(
+                'UPDATE results SET result = ?, comment = ?, date = ?, '
+                'revision = coalesce(?, revision), dirty = 1 '
+                'WHERE version = ? AND suite = ? AND test_id = ? '
+                'AND format = ?', (
+                    result, comment, date, revision, version, suite,
+                    test_id, format))
+        return bool(cursor.rowcount)
+
+    def export(self, version, suite):
+        """Write the dirty results to the implementation report."""
+        filename = self.filename(version, suite)
+        with self.batch():
+            dirty = {
+                (format, name): row for format, name, *row in
+                self.connection.execute(
+                    'SELECT format, name, revision, result, comment, date '
+                    'FROM results WHERE version = ? AND suite = ? '
+                    'AND dirty', (version, suite))}
+            if not dirty:
+                return
+            with open(filename) as fd:
+                lines = fd.readlines()
+            for i, line in enumerate(lines):
+                if line.startswith('#') or '/' not in line:
+                    continue
+                format, name = line.split('\t', 1)[0].split('/', 1)
+                if (format, name) in dirty:
+                    lines[i] = format_line(
+                        format, name, *dirty[format, name])
+            with open(filename + '.tmp', 'w') as fd:
+                fd.write(''.join(lines))
+            os.replace(filename + '.tmp', filename)
+            self.connection.execute(
+                'UPDATE results SET dirty = 0 '
+                'WHERE version = ? AND suite = ?', (version, suite))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO imports VALUES (?, ?, ?, ?)',
+                (version, suite) + self.stat(version, suite))
+
+    def export_all(self):
+        """Write all the dirty results to the implementation reports."""
+        with self._lock:
+            dirty = self.connection.execute(
+                'SELECT DISTINCT version, suite FROM results '
+                'WHERE dirty').fetchall()
+        for version, suite in dirty:
+            self.export(version, suite)
+
+
+class BlobStore:
+    """Files stored once in ``folder``, named by the SHA-1 of their content.
+
+    Files are shared by all the versions, manifests of versions map tests to
+    the hashes of their images.
+
+    """
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path(self, digest):
+        return os.path.join(self.folder, digest[:2], digest + '.png')
+
+    def __contains__(self, digest):
+        return os.path.isfile(self.path(digest))
+
+    def add(self, filename, digest=None):
+        """Move a file into the store, return its hash."""
+        if digest is None:
+            sha1 = hashlib.sha1()
+            with open(filename, 'rb') as fd:
+                for block in iter(lambda: fd.read(1024 * 1024), b''):
+                    sha1.update(block)
+            digest = sha1.hexdigest()
+        if digest in self:
+            os.remove(filename)
+        else:
+            os.makedirs(os.path.dirname(self.path(digest)), exist_ok=True)
+            os.replace(filename, self.path(digest))
+        return digest
+
+
+class SuiteTests:
+    """Metadata of the tests of a suite, shared by the results of versions.
+
+    ``weights`` store the number of times each test is listed in the
+    chapters of the suite. Tests only found in the result files of some
+    versions are added after the ``size`` tests of the suite.
+
+    """
+    def __init__(self, tests, chapters):
+        self.metadata = list(tests.values())
+        self.test_ids = list(tests)
+        self.size = len(self.metadata)
+        self.positions = {
+            test_id: position for position, test_id in enumerate(tests)}
+        self.weights = [0] * len(self.metadata)
+        for _, sections, _ in chapters:
+            for _, _, tests in sections:
+                for test in tests:
+                    self.weights[self.positions[test['test_id']]] += 1
+        self.number = sum(self.weights)
+
+    def add(self, test_id):
+        """Add a test only found in result files, return its position."""
+        if test_id in self.positions:
+            return self.positions[test_id]
+        self.positions[test_id] = len(self.metadata)
+        self.metadata.append({
+            'test_id': test_id, 'flags': None, 'references': {}})
+        self.weights.append(0)
+        return self.positions[test_id]
+
+
+class Results:
+    """Results of the tests of a suite for one version.
+
+    This is a mapping of test ids to ``TestResult`` objects. Results are
+    stored in lists indexed by the positions of the tests in ``tests``, and
+    totals of results are updated when a result is set. Tests only found in
+    the result file of the version are only given by these results.
+
+    """
+    fields = ('result', 'comment', 'date', 'revision')
+
+    def __init__(self, tests, default_result):
+        self.tests = tests
+        self.default_result = default_result
+        self.totals = {default_result: tests.number}
+        self._values = {}
+        self._added = {}
+
+    def __len__(self):
+        return self.tests.size + len(self._added)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, test_id):
+        position = self.tests.positions.get(test_id)
+        return position is not None and (
+            position < self.tests.size or test_id in self._added)
+
+    def __getitem__(self, test_id):
+        if test_id not in self:
+            raise KeyError(test_id)
+        return TestResult(self, self.tests.positions[test_id])
+
+    def keys(self):
+        return self.tests.test_ids + list(self._added)
+
+    def values(self):
+        return [TestResult(self, position) for _, position in self._items()]
+
+    def items(self):
+        return [
+            (test_id, TestResult(self, position))
+            for test_id, position in self._items()]
+
+    def _items(self):
+        yield from zip(self.tests.test_ids, range(self.tests.size))
+        yield from self._added.items()
+
+    def add(self, test_id):
+        if test_id not in self:
+            self._added[test_id] = self.tests.add(test_id)
+        return self[test_id]
+
+    def get_value(self, position, field):
+        values = self._values.get(field)
+        if values is None or position >= len(values):
+            return self.default_result if field == 'result' else None
+        return values[position]
+
+    def set_value(self, position, field, value):
+        if field == 'result':
+            weight = self.tests.weights[position]
+            old_value = self.get_value(position, field)
+            self.totals[old_value] -= weight
+            self.totals[value] = self.totals.get(value, 0) + weight
+        if field not in self._values:
+            self._values[field] = []
+        values = self._values[field]
+        if position >= len(values):
+            default = self.default_result if field == 'result' else None
+            values.extend([default] * (position + 1 - len(values)))
+        values[position] = value
+
+    def summary(self):
+        """Get the numbers of passed, failed and covered tests."""
+        return {
+            'pass': self.totals.get('pass', 0),
+            'fail': self.totals.get('fail', 0),
+            'count': self.tests.number - self.totals.get('?', 0)}
+
+
+class VersionResults(Mapping):
+    """Results of the tests of a suite for each version, loaded on demand.
+
+    ``load(version)`` returns the ``Results`` of a version, ``versions()``
+    returns the available versions. Results of the ``current`` version are
+    always kept, results of other versions are kept in ``cache``, a
+    ``cache.LRUCache`` shared by the suites, until ``stat(version)``
+    changes.
+
+    """
+    def __init__(self, load, versions, cache, current, stat):
+        self.load = load
+        self.versions = versions
+        self.cache = cache
+        self.current = current
+        self.stat = stat
+        self.current_results = load(current)
+        # Mappings are not hashable, results are cached with this key
+        self._key = object()
+
+    def __len__(self):
+        return len(self.versions())
+
+    def __iter__(self):
+        return iter(self.versions())
+
+    def __getitem__(self, version):
+        if version == self.current:
+            return self.current_results
+        if version not in self.versions():
+            raise KeyError(version)
+        key = self._key, version, self.stat(version)
+        results = self.cache.get(key)
+        if results is None:
+            results = self.cache[key] = self.load(version)
+        return results
+
+
+class TestResult:
+    """The result of a test for a version, with the metadata of the test.
+
+    It behaves as a dict whose result fields can be set.
+
+    """
+    __slots__ = ('_results', '_position')
+
+    def __init__(self, results, position):
+        self._results = results
+        self._position = position
+
+    def __getitem__(self, key):
+        if key in Results.fields:
+            return self._results.get_value(self._position, key)
+        return self._results.tests.metadata[self._position][key]
+
+    def __setitem__(self, key, value):
+        if key not in Results.fields:
+            raise KeyError(key)
+        self._results.set_value(self._position, key, value)
+
+    def __contains__(self, key):
+        if key in Results.fields:
+            return self[key] is not None
+        return key in self._results.tests.metadata[self._position]
+
+    def get(self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        return default if value is None else value
@@ -16,46 +16,146 @@ See http://test.csswg.org/suites/
 """
 
 import argparse
-import fileinput
+import atexit
+import csv
+import functools
+import hashlib
 import io
 import json
 import os
-import sys
-from base64 import b64encode
-from copy import deepcopy
+import pickle
+import shutil
+import subprocess
+import tempfile
+import threading
+import zlib
+from concurrent.futures import (
+    CancelledError, ProcessPoolExecutor, TimeoutError)
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from urllib.request import urlopen
 from zipfile import ZipFile
 
 import lxml.html
+import numpy
+import weasyprint
 from flask import (
-    Flask, abort, redirect, render_template, request, safe_join,
-    send_from_directory, url_for)
+    Flask, Response, abort, jsonify, redirect, render_template, request,
+    safe_join, send_file, send_from_directory, stream_with_context, url_for)
 from pygments import highlight
 from pygments.formatters import HtmlFormatter
 from pygments.lexers import HtmlLexer
-from weasyprint import CSS, HTML, VERSION
+from weasyprint import CSS, HTML, VERSION, default_url_fetcher
 
-parser = argparse.ArgumentParser()
+from cache import CachedFetcher, CachedStylesheets, LRUCache, RenderCache
+from images import surface_pixels
+from profiles import hot_functions, profile
+from store import (
+    BlobStore, Results, ResultStore, SuiteTests, VersionResults)
+from workers import CONTEXT
+
+# Options shared by the scripts, scripts add their own options to a parser
+# using this one as a parent
+parser = argparse.ArgumentParser(add_help=False)
 parser.add_argument('-v', '--version', action='version', version=VERSION)
 parser.add_argument('-w', '--write', action='store_true')
 parser.add_argument('-s', '--suite', action='append', dest='suites')
 parser.add_argument('-V', '--weasyprint-version', default=VERSION)
-options = parser.parse_args()
+parser.add_argument('-j', '--jobs', type=int)
+parser.add_argument('--timeout', type=float)
+parser.add_argument('--memory-limit', type=int, metavar='MEGABYTES')
+parser.add_argument('--max-tasks', type=int)
+parser.add_argument('--max-rss', type=int, metavar='MEGABYTES')
+parser.add_argument('--fuzz-difference', type=int, default=0)
+parser.add_argument('--fuzz-pixels', type=int, default=0)
+parser.add_argument('--prefetch', type=int, default=3)
+parser.add_argument('--max-pages', type=int, default=20)
+options, _ = parser.parse_known_args()
+
+
+def weasyprint_revision():
+    """Get the version of WeasyPrint, with its commit if it's a checkout."""
+    path = os.path.dirname(os.path.dirname(os.path.abspath(
+        weasyprint.__file__)))
+    try:
+        root, commit = subprocess.check_output(
+            ['git', 'rev-parse', '--show-toplevel', 'HEAD'], cwd=path,
+            stderr=subprocess.DEVNULL).decode().split()
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return VERSION
+    if os.path.abspath(root) != path:
+        # WeasyPrint is installed in a virtual environment in another repo
+        return VERSION
+    return '%s+%s' % (VERSION, commit)
 
-STYLESHEET = CSS(string='''
+
+STYLESHEET_SOURCE = '''
     @page { margin: 20px; size: 680px }
     body { margin: 0 }
     :root { image-rendering: pixelated }
-''')
+'''
+# Support files are shared by the tests, they're kept between renders
+URL_FETCHER = CachedFetcher(default_url_fetcher)
+STYLESHEETS = CachedStylesheets(
+    lambda filename: CSS(filename=filename, url_fetcher=URL_FETCHER))
+STYLESHEET = CSS(string=STYLESHEET_SOURCE)
+RENDERER = '%s/%s' % (
+    weasyprint_revision(),
+    hashlib.sha1(STYLESHEET_SOURCE.encode()).hexdigest()[:12])
 FOLDER = os.path.dirname(__file__)
 VERSION = options.weasyprint_version
 OUTPUT_FOLDER = os.path.join(FOLDER, 'results', VERSION, 'png')
+BLOBS_FOLDER = os.path.join(FOLDER, 'blobs')
+MANIFEST = 'manifest.json'
+METRICS = 'metrics.json'
+FLAKY = 'flaky.json'
+INDEX_FOLDER = os.path.join(FOLDER, 'cache', 'suites')
+INDEX_FORMAT = 3
 BASE_PATH = os.path.join(FOLDER, 'suites')
+DOWNLOAD_FOLDER = os.path.join(FOLDER, 'cache', 'downloads')
+PROFILE_FOLDER = os.path.join(FOLDER, 'cache', 'profiles')
+
+
+class Suites(dict):
+    """Loaded suites, suites are loaded when they're first accessed.
 
+    Only the suites given with ``--suite`` are loaded, if any.
 
-SUITES = {}
+    """
+    lock = threading.Lock()
+
+    def __missing__(self, suite):
+        if options.suites and suite not in options.suites:
+            raise KeyError(suite)
+        with self.lock:
+            if suite not in self:
+                add_suite(suite)
+        if suite not in self:
+            raise KeyError(suite)
+        return self.get(suite)
+
+
+SUITES = Suites()
 REFERENCES = {}
+RESULTS_CACHE = LRUCache(16)
+MANIFESTS = LRUCache(4)
+BLOBS = BlobStore(BLOBS_FOLDER)
+MATRIX_CACHE = LRUCache(8)
+RENDER_CACHE = RenderCache(os.path.join(FOLDER, 'cache', 'render'))
+DOCUMENTS = LRUCache(16)
+# Tests are rendered in the background while they're reviewed, rendered
+# pages are shared with the workers through the render cache folder.
+# Workers are started by start_render_pool before the server threads, and
+# tests taking more than RENDER_TIMEOUT seconds are rendered again.
+RENDER_POOL = ProcessPoolExecutor(options.jobs or 2, mp_context=CONTEXT)
+RENDER_TIMEOUT = options.timeout or 60
+RENDERING = {}
+STORE = ResultStore(
+    os.path.join(FOLDER, 'cache', 'results.sqlite'),
+    os.path.join(FOLDER, 'results'))
+# Results saved by batches in the store are written to the result files on
+# exit, if they haven't been written before
+atexit.register(STORE.export_all)
 
 try:
     ALL_SUITES = json.load(open(os.path.join(BASE_PATH, 'suites.json')))
@@ -66,20 +166,67 @@ except:
 app = Flask(__name__)
 
 
-def add_suite(suite):
-    if suite in SUITES:
-        del SUITES[suite]
-    suite_path = os.path.join(BASE_PATH, suite)
-    if not os.path.isdir(suite_path):
-        return
-    date, = os.listdir(suite_path)
-    suite_path = os.path.join(suite_path, date)
-    formats = set(os.listdir(suite_path))
-    format = [format for format in formats if format.startswith('html')].pop()
-    name = suite
-    if ALL_SUITES.get(suite):
-        name = ALL_SUITES[suite].get('name', suite)
+def stat_files(filenames):
+    """Get the modification times and sizes of files, ``None`` if missing."""
+    stats = {}
+    for filename in filenames:
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            stats[filename] = None
+        else:
+            stats[filename] = (stat.st_mtime_ns, stat.st_size)
+    return stats
+
+
+def read_index(suite):
+    """Read the parsed suite saved by ``write_index``.
+
+    Return ``None`` if the index is missing, or if one of the files parsed
+    or one of the folders listed to build it has changed.
+
+    """
+    filename = os.path.join(INDEX_FOLDER, suite + '.pickle')
+    try:
+        with open(filename, 'rb') as fd:
+            index = pickle.load(fd)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if index.get('index_format') != INDEX_FORMAT:
+        return None
+    if stat_files(index['files']) != index['files']:
+        return None
+    return index
+
+
+def write_index(suite, index):
+    os.makedirs(INDEX_FOLDER, exist_ok=True)
+    filename = os.path.join(INDEX_FOLDER, suite + '.pickle')
+    with open(filename + '.tmp', 'wb') as fd:
+        pickle.dump(index, fd, pickle.HIGHEST_PROTOCOL)
+    os.replace(filename + '.tmp', filename)
+
+
+def parse_suite(suite_path):
+    """Parse the references, the tests and the chapters of a suite.
+
+    Tests, references and chapters are the same in all the formats, they're
+    parsed once from the main format, the first HTML one.
+
+    """
+    formats = sorted(
+        format for format in os.listdir(suite_path)
+        if os.path.isfile(os.path.join(suite_path, format, 'reftest.list')))
+    format = next(
+        (format for format in formats if format.startswith('html')),
+        formats[0])
+    folders = []
+    test_files = {
+        format: index_files(os.path.join(suite_path, format), folders)
+        for format in formats}
+    suite_references = {}
     filename = os.path.join(suite_path, format, 'reftest.list')
+    files = [filename, os.path.join(suite_path, 'testinfo.data')]
     with open(filename) as fd:
         for line in fd.readlines():
             # Remove comments
@@ -104,6 +251,7 @@ def add_suite(suite):
             if test not in REFERENCES:
                 REFERENCES[test] = {}
             REFERENCES[test][equal] = references
+            suite_references[test] = REFERENCES[test]
 
     tests_by_link = {}
     current_tests = {}
@@ -119,8 +267,10 @@ def add_suite(suite):
     filename = os.path.join(suite_path, 'toc.html')
     if not os.path.isfile(filename):
         filename = filename[:-1]
+    files.append(filename)
     for link in lxml.html.parse(filename).xpath('//table//a[@href]'):
         filename = os.path.join(suite_path, link.get('href'))
+        files.extend((filename, chapter_index(filename)))
         sections = list(read_chapter(filename, tests_by_link))
         if sections:
             num = sum(len(tests) for _, _, tests in sections)
@@ -139,71 +289,91 @@ def add_suite(suite):
         chapters.append(
             ('Unknown', [('Unknown', '', unknown_tests)], len(unknown_tests)))
 
-    SUITES[suite] = {
-        'date': date, 'format': format, 'name': name, 'results': {},
-        'path': suite_path, 'chapters': chapters}
+    return {
+        'index_format': INDEX_FORMAT, 'files': stat_files(files + folders),
+        'format': format, 'formats': formats, 'references': suite_references,
+        'tests': current_tests, 'chapters': chapters,
+        'test_files': test_files}
 
-    # Set VERSION at the end to duplicate the tests dict for all other versions
-    versions = [
-        version for version in os.listdir(os.path.join(FOLDER, 'results'))
-        if version != VERSION] + [VERSION]
-    for version in versions:
-        if version == VERSION:
-            tests = current_tests
-        else:
-            tests = deepcopy(current_tests)
-        SUITES[suite]['results'][version] = tests
-        filename = os.path.join(FOLDER, 'results', version, suite)
-        if os.path.isfile(filename):
-            results = iter(open(filename).readlines())
-            default_result = 'unavailable'
-        else:
-            results = []
-            default_result = '?'
 
-        for result_line in results:
-            if result_line.startswith('testname'):
-                included_revision = 'revision' in result_line
+def result_versions():
+    """Get the versions with results, including the tested version."""
+    versions = os.listdir(os.path.join(FOLDER, 'results'))
+    if VERSION not in versions:
+        versions.append(VERSION)
+    return versions
+
+
+def load_results(suite, format, tests, version):
+    """Load the results of the tests of a suite for a version."""
+    if STORE.sync(version, suite):
+        rows = STORE.results(version, suite, format)
+        results = Results(tests, 'unavailable')
+    else:
+        rows = []
+        results = Results(tests, '?')
+
+    for name, revision, result, comment, date in rows:
+        if date is not None:
+            date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
+        test_id_parts = name.split('.')
+        for i in range(len(test_id_parts)):
+            test_id = '.'.join(test_id_parts[:-i])
+            if test_id in results:
                 break
+        test = results.add(test_id)
+        test['result'] = result
+        test['comment'] = comment
+        test['date'] = date
+        if revision is not None:
+            test['revision'] = revision
+    return results
 
-        for result_line in results:
-            result_line = result_line[:-1]
-            if result_line.startswith(SUITES[suite]['format']):
-                if included_revision:
-                    if result_line.count('\t') < 3:
-                        name, revision, result = (
-                            result_line.split('\t', 2))
-                        comment = ''
-                    else:
-                        name, revision, result, comment = (
-                            result_line.split('\t', 3))
-                else:
-                    name, result, comment = result_line.split('\t', 2)
-                if '\t' in comment:
-                    comment, date = comment.split('\t')
-                    date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
-                else:
-                    date = None
-                format, test_id = name.split('/')
-                if format == SUITES[suite]['format']:
-                    test_id_parts = test_id.split('.')
-                    for i in range(len(test_id_parts)):
-                        test_id = '.'.join(test_id_parts[:-i])
-                        if test_id in tests:
-                            break
-                    if test_id not in tests:
-                        tests[test_id] = {}
-                    tests[test_id]['result'] = result
-                    tests[test_id]['comment'] = comment
-                    tests[test_id]['date'] = date
-                    if included_revision:
-                        tests[test_id]['revision'] = revision
 
-        for test in tests:
-            if 'result' not in tests[test]:
-                tests[test]['result'] = default_result
-                tests[test]['comment'] = None
-                tests[test]['date'] = None
+def suite_name(suite):
+    if ALL_SUITES.get(suite):
+        return ALL_SUITES[suite].get('name', suite)
+    return suite
+
+
+def add_suite(suite):
+    MATRIX_CACHE.pop(suite)
+    suite_path = os.path.join(BASE_PATH, suite)
+    if not os.path.isdir(suite_path):
+        SUITES.pop(suite, None)
+        return
+    date, = os.listdir(suite_path)
+    suite_path = os.path.join(suite_path, date)
+    index = read_index(suite)
+    if index is None:
+        index = parse_suite(suite_path)
+        write_index(suite, index)
+    else:
+        REFERENCES.update(index['references'])
+    format, current_tests = index['format'], index['tests']
+
+    # Results of other versions are loaded when they're used
+    tests = SuiteTests(current_tests, index['chapters'])
+    results = VersionResults(
+        functools.partial(load_results, suite, format, tests),
+        result_versions, RESULTS_CACHE, VERSION,
+        lambda version: STORE.stat(version, suite))
+
+    # Chapters give the results of the tested version
+    current_results = results[VERSION]
+    chapters = [
+        (chapter, [
+            (section, link, [
+                current_results[test['test_id']] for test in section_tests])
+            for section, link, section_tests in sections], number)
+        for chapter, sections, number in index['chapters']]
+
+    # The suite is only given to other threads once it's complete
+    SUITES[suite] = {
+        'date': date, 'format': format, 'formats': index['formats'],
+        'name': suite_name(suite), 'results': results,
+        'path': os.path.join(suite_path, format), 'tests': tests,
+        'chapters': chapters, 'files': index['test_files']}
 
 
 def read_testinfo(suite_directory):
@@ -220,12 +390,16 @@ def read_testinfo(suite_directory):
                 references=REFERENCES.get(test_id, {}))
 
 
-def read_chapter(filename, tests_by_link):
+def chapter_index(filename):
     index_filename = os.path.join(
         os.path.dirname(os.path.dirname(filename)), 'index.html')
     if not os.path.isfile(index_filename):
         index_filename = index_filename[:-1]
-    url_prefix = lxml.html.parse(index_filename).xpath(
+    return index_filename
+
+
+def read_chapter(filename, tests_by_link):
+    url_prefix = lxml.html.parse(chapter_index(filename)).xpath(
         '//a[contains(@href, "://www.w3.org/TR/")]')[0].get('href')
     chapter = lxml.html.parse(filename)
     for link in chapter.xpath(
@@ -243,8 +417,78 @@ def read_chapter(filename, tests_by_link):
             yield link.text_content().strip(), link.get('href'), tests
 
 
-def save_test(suite, test):
-    format = SUITES[suite]['format']
+def index_files(path, folders=None):
+    """Map test ids and relative paths to the files in ``path``.
+
+    Keys are lowercase paths relative to ``path``, with and without their
+    extensions. Ids shared by files with different extensions give the first
+    file in alphabetical order. The first parts of dotted names are also
+    used as ids, when no file has this exact id. Listed folders are added
+    to ``folders``, if given.
+
+    """
+    files = {}
+    prefixes = {}
+    for root, directories, filenames in os.walk(path):
+        directories.sort()
+        if folders is not None:
+            folders.append(root)
+        folder = os.path.relpath(root, path).replace(os.sep, '/').lower()
+        folder = '' if folder == '.' else folder + '/'
+        for filename in sorted(filenames):
+            full_filename = os.path.join(root, filename)
+            parts = filename.lower().split('.')
+            files[folder + filename.lower()] = full_filename
+            files.setdefault(
+                folder + '.'.join(parts[:-1] or parts), full_filename)
+            for i in range(1, len(parts) - 1):
+                prefixes.setdefault(
+                    folder + '.'.join(parts[:i]), full_filename)
+    for test_id, filename in prefixes.items():
+        files.setdefault(test_id, filename)
+    return files
+
+
+def find_file(suite, test_id, format=None):
+    """Get the path of the file of a test, ``None`` if it's missing.
+
+    The file is searched in ``format``, the main format of the suite by
+    default.
+
+    """
+    format = format or SUITES[suite]['format']
+    return SUITES[suite]['files'][format].get(test_id.lower())
+
+
+def format_key(suite, test_id, format):
+    """Get the name of the rendering of a test in a format in manifests.
+
+    Renderings of the main format of the suite are named by test id, other
+    ones are named like in the implementation reports, ``format/test_id``.
+
+    """
+    if format == SUITES[suite]['format']:
+        return test_id
+    return '{}/{}'.format(format, test_id)
+
+
+def split_key(suite, key):
+    """Get the format and the test id of a rendering in manifests."""
+    format, _, test_id = key.partition('/')
+    if test_id and format in SUITES[suite]['formats']:
+        return format, test_id
+    return SUITES[suite]['format'], key
+
+
+def save_tests(suite, tests, format=None):
+    """Save the results of tests for the tested version.
+
+    Results are saved for ``format``, the main format of the suite by
+    default.
+
+    """
+    main_format = SUITES[suite]['format']
+    format = format or main_format
     filename = os.path.join(FOLDER, 'results', VERSION, suite)
     if not os.path.exists(os.path.dirname(filename)):
         os.mkdir(os.path.dirname(filename))
@@ -257,18 +501,196 @@ def save_test(suite, test):
         lines[1] = '#\n'
         lines[2] = lines[2].replace('DATESTAMP', SUITES[suite]['date'])
         for i, line in enumerate(lines):
-            if line.startswith(format) and '/' in line:
-                lines[i] = '/'.join((format, line.split('/', 1)[1]))
+            if line.startswith(main_format) and '/' in line:
+                lines[i] = '/'.join((main_format, line.split('/', 1)[1]))
         open(filename, 'w').write(''.join(lines))
-    for line in fileinput.input(filename, inplace=1):
-        if line.startswith('/'.join((format, test['test_id'] + '.'))):
-            line = [
-                line.split('\t')[0], test['result'] or '?',
-                test['comment'] or '', str(test['date'])]
-            if 'revision' in test:
-                line.insert(1, test['revision'])
-            line = '\t'.join(line) + '\n'
-        sys.stdout.write(line)
+    MATRIX_CACHE.pop(suite)
+    results = SUITES[suite]['results'][VERSION]
+    with STORE.batch():
+        STORE.sync(VERSION, suite)
+        for test in tests:
+            STORE.save(
+                VERSION, suite, format, test['test_id'],
+                test['result'] or '?', test.get('comment') or '',
+                test['date'] and str(test['date']), test.get('revision'))
+            if format == main_format and test['test_id'] in results:
+                current_test = results[test['test_id']]
+                current_test['result'] = test['result'] or '?'
+                current_test['comment'] = test.get('comment')
+                current_test['date'] = test['date']
+
+
+def save_test(suite, test):
+    """Save the result of a test and write it to the result file at once."""
+    save_tests(suite, [test])
+    STORE.export(VERSION, suite)
+
+
+def file_hash(filename):
+    """Get the SHA-1 hex digest of the file, or ``None`` if missing."""
+    sha1 = hashlib.sha1()
+    try:
+        with open(filename, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(1 << 16), b''):
+                sha1.update(chunk)
+    except OSError:
+        return None
+    return sha1.hexdigest()
+
+
+def read_manifest(version=None, folder=None):
+    """Read the manifest of the PNG files generated for ``version``.
+
+    The manifest stores, for each test, the renderer used, the status of
+    the render, the hashes of the files it has read and of the generated
+    image. It also keeps a log of the runs that regenerated the files.
+    ``folder`` overrides the folder of the PNG files of ``version``.
+
+    """
+    folder = folder or os.path.join(
+        FOLDER, 'results', version or VERSION, 'png')
+    filename = os.path.join(folder, MANIFEST)
+    if os.path.isfile(filename):
+        with open(filename) as fd:
+            return json.load(fd)
+    return {'tests': {}, 'runs': []}
+
+
+def write_manifest(manifest, version=None, folder=None):
+    folder = folder or os.path.join(
+        FOLDER, 'results', version or VERSION, 'png')
+    filename = os.path.join(folder, MANIFEST)
+    os.makedirs(folder, exist_ok=True)
+    with open(filename + '.tmp', 'w') as fd:
+        json.dump(manifest, fd, indent=1, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+
+def version_manifest(version):
+    """Get the manifest of ``version``, cached until it's written again."""
+    filename = os.path.join(FOLDER, 'results', version, 'png', MANIFEST)
+    try:
+        key = filename, os.path.getmtime(filename)
+    except OSError:
+        key = None
+    manifest = MANIFESTS.get(key)
+    if manifest is None:
+        manifest = MANIFESTS[key] = read_manifest(version)
+    return manifest
+
+
+def different_formats(suite, test_id, version=None, manifest=None):
+    """Get the formats where a test isn't rendered like in the main format.
+
+    Renderings are compared with the hashes of their pixels stored in
+    ``manifest``, the manifest of ``version`` by default. Formats whose
+    rendering is missing are ignored.
+
+    """
+    if manifest is None:
+        manifest = version_manifest(version or VERSION)
+    pixels = manifest['tests'].get(test_id, {}).get('pixels')
+    if pixels is None:
+        return []
+    formats = []
+    for format in SUITES[suite]['formats']:
+        other_pixels = manifest['tests'].get(
+            format_key(suite, test_id, format), {}).get('pixels')
+        if other_pixels not in (None, pixels):
+            formats.append(format)
+    return formats
+
+
+def test_image(version, test_id, manifest=None):
+    """Get the filename of the image generated for a test by a version.
+
+    Images are found with the hashes stored in ``manifest``, the manifest of
+    the version by default. Images of versions generated before the images
+    were stored by hash are also found. Return ``None`` if there's no image.
+
+    """
+    if manifest is None:
+        manifest = version_manifest(version)
+    digest = manifest['tests'].get(test_id, {}).get('png')
+    if digest and digest in BLOBS:
+        return BLOBS.path(digest)
+    filename = safe_join(
+        os.path.join(FOLDER, 'results', version, 'png'),
+        '{}.png'.format(test_id))
+    if filename and os.path.isfile(filename):
+        return filename
+
+
+def read_metrics(version=None, folder=None):
+    """Read the metrics of the renderings of ``version``.
+
+    Metrics are stored by suite and by test, with the times spent to parse,
+    lay out and paint the test in seconds, the peak resident set size of
+    the rendering process in kilobytes, and the number of pages.
+    ``folder`` overrides the results folder of ``version``.
+
+    """
+    folder = folder or os.path.join(FOLDER, 'results', version or VERSION)
+    filename = os.path.join(folder, METRICS)
+    if os.path.isfile(filename):
+        with open(filename) as fd:
+            return json.load(fd)
+    return {}
+
+
+def write_metrics(metrics, version=None, folder=None):
+    folder = folder or os.path.join(FOLDER, 'results', version or VERSION)
+    filename = os.path.join(folder, METRICS)
+    os.makedirs(folder, exist_ok=True)
+    with open(filename + '.tmp', 'w') as fd:
+        json.dump(metrics, fd, indent=1, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+
+def read_flaky(version=None):
+    """Read the tests whose renderings change between runs of ``version``.
+
+    Tests are stored with the number of runs used to find them and the
+    number of unstable pixels. The masks of these pixels are stored in the
+    ``masks`` folder of the results of the version.
+
+    """
+    filename = os.path.join(FOLDER, 'results', version or VERSION, FLAKY)
+    if os.path.isfile(filename):
+        with open(filename) as fd:
+            return json.load(fd)
+    return {}
+
+
+def write_flaky(flaky, version=None):
+    folder = os.path.join(FOLDER, 'results', version or VERSION)
+    filename = os.path.join(folder, FLAKY)
+    os.makedirs(folder, exist_ok=True)
+    with open(filename + '.tmp', 'w') as fd:
+        json.dump(flaky, fd, indent=1, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+
+def mask_filename(version, test_id):
+    return os.path.join(
+        FOLDER, 'results', version, 'masks', '{}.npz'.format(test_id))
+
+
+def read_mask(version, test_id):
+    """Get the mask of the unstable pixels of a test, ``None`` if stable."""
+    try:
+        with numpy.load(mask_filename(version, test_id)) as masks:
+            return masks['mask']
+    except OSError:
+        return None
+
+
+def write_mask(mask, version, test_id):
+    filename = mask_filename(version, test_id)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename + '.tmp', 'wb') as fd:
+        numpy.savez_compressed(fd, mask=mask)
+    os.replace(filename + '.tmp', filename)
 
 
 @app.route('/', methods=('GET', 'POST'))
@@ -286,9 +708,15 @@ def toc():
                 ALL_SUITES[suite] = None
         with open(os.path.join(BASE_PATH, 'suites.json'), 'w') as fd:
             json.dump(ALL_SUITES, fd)
-    missing_suites = [suite for suite in ALL_SUITES if suite not in SUITES]
+    folders = [
+        suite for suite in os.listdir(BASE_PATH)
+        if os.path.isdir(os.path.join(BASE_PATH, suite))]
+    suites = {
+        suite: suite_name(suite) for suite in folders
+        if not options.suites or suite in options.suites}
+    missing_suites = [suite for suite in ALL_SUITES if suite not in folders]
     return render_template(
-        'toc.html.jinja2', suites=SUITES, missing_suites=missing_suites)
+        'toc.html.jinja2', suites=suites, missing_suites=missing_suites)
 
 
 @app.route('/suite-<suite>/')
@@ -301,6 +729,68 @@ def suite(suite):
         total=len(SUITES[suite]['results'][VERSION]))
 
 
+def download(url, folder):
+    """Stream the file at ``url`` to a temporary file in ``folder``.
+
+    Return the name of the temporary file, removed if the download fails.
+
+    """
+    response = urlopen(url)
+    fd = tempfile.NamedTemporaryFile(dir=folder, delete=False)
+    try:
+        with fd:
+            shutil.copyfileobj(response, fd, 1024 * 1024)
+        length = response.headers.get('Content-Length')
+        if length is not None and os.path.getsize(fd.name) != int(length):
+            raise IOError('Incomplete download of %s' % url)
+    except BaseException:
+        os.remove(fd.name)
+        raise
+    return fd.name
+
+
+def same_file(filename, info):
+    """Check whether a file has the size and the CRC of a zip member."""
+    try:
+        if os.path.getsize(filename) != info.file_size:
+            return False
+        crc = 0
+        with open(filename, 'rb') as fd:
+            for block in iter(lambda: fd.read(1024 * 1024), b''):
+                crc = zlib.crc32(block, crc)
+    except OSError:
+        return False
+    return crc == info.CRC
+
+
+def extract_suite(zip_file, path, old_path=None):
+    """Extract a suite in ``path``, return the name of its folder.
+
+    Files of the previous version of the suite, stored in ``old_path``, are
+    linked instead of being extracted again when they have not changed,
+    keeping their modification times.
+
+    """
+    members = [info for info in zip_file.infolist() if not info.is_dir()]
+    folder, = {info.filename.split('/')[0] for info in members}
+    for info in members:
+        parts = info.filename.split('/')
+        filename = os.path.normpath(os.path.join(path, info.filename))
+        if not filename.startswith(os.path.join(path, '')):
+            continue
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        old_filename = old_path and os.path.join(old_path, *parts[1:])
+        if old_filename and same_file(old_filename, info):
+            try:
+                os.link(old_filename, filename)
+            except OSError:
+                shutil.copy2(old_filename, filename)
+            continue
+        with zip_file.open(info) as source, open(filename, 'wb') as fd:
+            shutil.copyfileobj(source, fd, 1024 * 1024)
+    return folder
+
+
 @app.route('/download-suite-<suite>/')
 def download_suite(suite):
     if not app.config['DEBUG']:
@@ -314,12 +804,40 @@ def download_suite(suite):
     else:
         assert 'nightly-unstable' in versions
         version = 'nightly-unstable'
-    zip_data = urlopen(
-        'http://test.csswg.org/suites/%s_dev/%s.zip' % (suite, version))
-    zip_file = ZipFile(io.BytesIO(zip_data.read()))
-    os.mkdir(os.path.join(BASE_PATH, suite))
-    zip_file.extractall(os.path.join(BASE_PATH, suite))
-    folder, = os.listdir(os.path.join(BASE_PATH, suite))
+
+    # Suites are downloaded and extracted in a temporary folder, moved to
+    # the suites folder once they're complete
+    suite_path = os.path.join(BASE_PATH, suite)
+    os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+    temp_path = tempfile.mkdtemp(dir=DOWNLOAD_FOLDER)
+    old_path = None
+    if os.path.isdir(suite_path):
+        old_path = os.path.join(suite_path, os.listdir(suite_path)[0])
+    try:
+        zip_filename = download(
+            'http://test.csswg.org/suites/%s_dev/%s.zip' % (suite, version),
+            DOWNLOAD_FOLDER)
+        try:
+            with ZipFile(zip_filename) as zip_file:
+                if zip_file.testzip() is not None:
+                    return abort(502)
+                folder = extract_suite(zip_file, temp_path, old_path)
+        finally:
+            os.remove(zip_filename)
+        if old_path:
+            os.rename(suite_path, temp_path + '.old')
+        try:
+            os.rename(temp_path, suite_path)
+        except OSError:
+            # Put the previous suite back
+            if old_path:
+                os.rename(temp_path + '.old', suite_path)
+            raise
+        if old_path:
+            shutil.rmtree(temp_path + '.old', ignore_errors=True)
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+
     index_file, = [
         filename for filename in
         os.listdir(os.path.join(BASE_PATH, suite, folder))
@@ -333,34 +851,143 @@ def download_suite(suite):
     if name.endswith(' Conformance'):
         name = name[:-12]
     ALL_SUITES[suite] = {'name': name}
-    add_suite(suite)
+    with SUITES.lock:
+        add_suite(suite)
     with open(os.path.join(BASE_PATH, 'suites.json'), 'w') as fd:
         json.dump(ALL_SUITES, fd)
     return redirect(url_for('suite', suite=suite))
 
 
+def results_matrix(suite):
+    """Get the results of the tests of a suite for all the versions.
+
+    The matrix is cached until one of the result files of the suite changes,
+    or until a result is saved.
+
+    """
+    versions = sorted(result_versions())
+    stats = stat_files(STORE.filename(version, suite) for version in versions)
+    cached = MATRIX_CACHE.get(suite)
+    if cached is not None and cached[0] == stats:
+        return cached[1]
+
+    results = [SUITES[suite]['results'][version] for version in versions]
+    chapters = [
+        (chapter, [
+            (section, link, [
+                (test['test_id'], [
+                    (version_results[test['test_id']]['result'],
+                     version_results[test['test_id']]['comment'])
+                    for version_results in results])
+                for test in tests])
+            for section, link, tests in sections])
+        for chapter, sections, _ in SUITES[suite]['chapters']]
+    matrix = {
+        'versions': versions, 'chapters': chapters,
+        'number': SUITES[suite]['tests'].number,
+        'totals': [version_results.summary() for version_results in results]}
+    MATRIX_CACHE[suite] = stats, matrix
+    return matrix
+
+
+def stream_template(template_name, **context):
+    """Render a template as a stream of strings."""
+    app.update_template_context(context)
+    return app.jinja_env.get_template(template_name).generate(context)
+
+
 @app.route('/suite-<suite>/results/')
 def suite_results(suite):
     suite_name = SUITES[suite]['name']
-    chapters = SUITES[suite]['chapters']
-    results = deepcopy(SUITES[suite]['results'])
-    number = 0
-    for version in results:
-        results[version].update({'pass': 0, 'fail': 0, 'count': 0})
-    for (name, sections, test_number) in chapters:
-        for name, link, tests in sections:
-            for test in tests:
-                number += 1
-                for version in results:
-                    version_test = results[version][test['test_id']]
-                    if version_test['result'] != '?':
-                        results[version]['count'] += 1
-                    if version_test['result'] in results[version]:
-                        results[version][version_test['result']] += 1
+    matrix = results_matrix(suite)
+    return Response(stream_with_context(stream_template(
+        'suite_results.html.jinja2', suite=suite, suite_name=suite_name,
+        **matrix)))
+
+
+@app.route('/suite-<suite>/results.json')
+def suite_results_json(suite):
+    matrix = results_matrix(suite)
+    versions = matrix['versions']
+    tests = [{
+        'test_id': test_id, 'chapter': chapter, 'section': section,
+        'results': {
+            version: {'result': result, 'comment': comment}
+            for version, (result, comment) in zip(versions, results)}}
+        for chapter, sections in matrix['chapters']
+        for section, _, tests in sections
+        for test_id, results in tests]
+    return jsonify(
+        versions=versions, number=matrix['number'],
+        totals=dict(zip(versions, matrix['totals'])), tests=tests)
+
+
+@app.route('/suite-<suite>/results.csv')
+def suite_results_csv(suite):
+    matrix = results_matrix(suite)
+
+    def lines():
+        line = io.StringIO()
+        writer = csv.writer(line)
+        writer.writerow(['test_id', 'chapter', 'section'] + matrix['versions'])
+        for chapter, sections in matrix['chapters']:
+            for section, _, tests in sections:
+                for test_id, results in tests:
+                    writer.writerow([test_id, chapter, section] + [
+                        result for result, _ in results])
+                    yield line.getvalue()
+                    line.seek(0)
+                    line.truncate()
+
+    return Response(lines(), mimetype='text/csv')
+
+
+@app.route('/suite-<suite>/performance/')
+def suite_performance(suite):
+    suite_name = SUITES[suite]['name']
+    metrics = {}
+    for version in os.listdir(os.path.join(FOLDER, 'results')):
+        version_metrics = read_metrics(version).get(suite)
+        if version_metrics:
+            metrics[version] = version_metrics
+    versions = sorted(metrics)
+    new = request.args.get('new', VERSION if VERSION in metrics else None)
+    if new not in metrics:
+        new = versions[-1] if versions else None
+    old = request.args.get('old')
+    if old not in metrics:
+        older = versions[:versions.index(new)] if new else []
+        old = older[-1] if older else None
 
+    def total(test):
+        return test['parse'] + test['layout'] + test['encode']
+
+    def test_url(key):
+        # Only tests of the main format have a page, other formats give
+        # their stored images
+        format, test_id = split_key(suite, key)
+        if format == SUITES[suite]['format']:
+            return url_for('run_test', suite=suite, test_id=test_id)
+        return url_for('stored_image', version=new, test_id=key)
+
+    slowest = []
+    regressions = []
+    if new:
+        new_metrics = metrics[new]
+        slowest = sorted(
+            new_metrics.items(), key=lambda item: total(item[1]),
+            reverse=True)[:50]
+    if new and old:
+        old_metrics = metrics[old]
+        regressions = sorted((
+            (test_id, old_metrics[test_id], test,
+             total(test) - total(old_metrics[test_id]))
+            for test_id, test in new_metrics.items()
+            if test_id in old_metrics), key=lambda item: item[3],
+            reverse=True)
+        regressions = [item for item in regressions if item[3] > 0][:50]
     return render_template(
-        'suite_results.html.jinja2', suite=suite, suite_name=suite_name,
-        chapters=chapters, number=number, results=results)
+        'suite_performance.html.jinja2', **locals())
 
 
 @app.route('/suite-<suite>/chapter<int:chapter_num>/section<int:section_num>/')
@@ -371,6 +998,9 @@ def section(suite, chapter_num, section_num):
         title, url, tests = sections[section_num - 1]
     except IndexError:
         abort(404)
+    differences = {
+        test['test_id']: different_formats(suite, test['test_id'])
+        for test in tests}
     return render_template('section.html.jinja2', **locals())
 
 
@@ -396,7 +1026,10 @@ def run_test(suite, chapter_num=None, section_num=None, test_index=None,
         except IndexError:
             abort(404)
     else:
-        test = dict(test_id=test_id)
+        results = SUITES[suite]['results'][VERSION]
+        if test_id not in results:
+            abort(404)
+        test = results[test_id]
 
     if request.method == 'POST':
         if not app.config['DEBUG']:
@@ -414,11 +1047,21 @@ def run_test(suite, chapter_num=None, section_num=None, test_index=None,
             save_test(suite, test)
             return redirect(request.path)
 
-    filenames = [
-        filename for filename in os.listdir(SUITES[suite]['path'])
-        if filename.lower().startswith(test_id + '.')]
-    if filenames:
-        filename = safe_join(SUITES[suite]['path'], filenames[0])
+    stylesheet = request.args.get('stylesheet')
+    media_type = request.args.get('media_type')
+    version = VERSION
+    formats = [
+        (format, format_key(suite, test_id, format))
+        for format in different_formats(suite, test_id)]
+    if test_index is not None and options.prefetch:
+        # The next tests are rendered while the current one is reviewed
+        prefetch(suite, [
+            next_test['test_id'] for next_test in
+            tests[test_index - 1:test_index + options.prefetch]],
+            media_type or 'print', stylesheet)
+
+    filename = find_file(suite, test_id)
+    if filename:
         with open(filename, 'rb') as fd:
             try:
                 source = fd.read().decode('utf8')
@@ -428,47 +1071,201 @@ def run_test(suite, chapter_num=None, section_num=None, test_index=None,
         formatter = HtmlFormatter(linenos='inline')
         source = highlight(source, HtmlLexer(), formatter)
         css = formatter.get_style_defs('.highlight')
-    stylesheet = request.args.get('stylesheet')
-    media_type = request.args.get('media_type')
     return render_template('run_test.html.jinja2', **locals())
 
 
-@app.route('/render/suite-<suite>/<path:test_id>')
-@app.route('/render/suite-<suite>/<path:test_id>/media-<media_type>')
-@app.route('/render/suite-<suite>/<path:test_id>/style-<stylesheet>')
-def render(suite, test_id, media_type='print', stylesheet=None):
-    folder = SUITES[suite]['path']
+def render_pixels(filename):
+    """Render a test, return its pixels."""
+    document = HTML(
+        filename, encoding='utf8', url_fetcher=URL_FETCHER).render(
+        stylesheets=[STYLESHEET], presentational_hints=True)
+    surface, _, _ = document.write_image_surface()
+    return surface_pixels(surface)
+
+
+def render_key(suite, test_id, media_type='print', stylesheet=None):
+    """Get the render cache key and the files needed to render a test.
+
+    Return ``(key, filename, stylesheet_filename)``, or ``None`` if one of
+    the files is missing.
+
+    """
+    filename = find_file(suite, test_id)
+    stylesheet_filename = stylesheet and find_file(
+        suite, 'support/' + stylesheet)
+    if filename is None or (stylesheet and stylesheet_filename is None):
+        return None
+    key = hashlib.sha1('\n'.join((
+        RENDERER, media_type, file_hash(filename),
+        file_hash(stylesheet_filename) if stylesheet else '',
+    )).encode()).hexdigest()
+    return key, filename, stylesheet_filename
+
+
+def render_document(key, filename, media_type, stylesheet_filename=None):
+    """Lay out a test and store the sizes of its pages in the render cache.
+
+    The laid out document is kept in memory to rasterize its other pages on
+    demand, only its first page is rasterized.
+
+    """
     stylesheets = [STYLESHEET]
-    if stylesheet:
-        stylesheets.append(os.path.join(folder, 'support', stylesheet))
-    if '/' in test_id:
-        folder = os.path.join(folder, os.path.dirname(test_id))
-        test_id = os.path.basename(test_id)
-    filename = [
-        filename for filename in os.listdir(folder)
-        if filename.lower().startswith(test_id + '.')][0]
-    filename = safe_join(folder, filename)
+    if stylesheet_filename:
+        stylesheets.append(STYLESHEETS.get(stylesheet_filename))
     document = (
-        HTML(filename, encoding='utf8', media_type=media_type)
+        HTML(filename, encoding='utf8', media_type=media_type,
+             url_fetcher=URL_FETCHER)
         .render(stylesheets=stylesheets, enable_hinting=True,
                 presentational_hints=True))
+    DOCUMENTS[key] = document
+    RENDER_CACHE.set(key, {
+        'pages': [(page.width, page.height) for page in document.pages],
+        'render': (filename, media_type, stylesheet_filename)})
+    if document.pages:
+        rasterize_page(key, document, 0)
+    return document
+
+
+def prefetch_document(key, filename, media_type, stylesheet_filename=None):
+    """Lay out a test in a background worker, return the sizes of its pages.
+
+    Documents can't be sent back from the workers, they're only stored in
+    the render cache.
+
+    """
+    document = render_document(
+        key, filename, media_type, stylesheet_filename)
+    return [(page.width, page.height) for page in document.pages]
+
+
+def rasterize_page(key, document, page):
+    """Rasterize a page of a document and store it in the render cache."""
+    png = document.copy([document.pages[page]]).write_png()[0]
+    RENDER_CACHE.set_page(key, page, png)
+    return png
+
+
+def start_render_pool():
+    """Fork the render workers, before any thread holds a lock."""
+    RENDER_POOL.submit(int).result()
+
+
+def prefetch(suite, tests, media_type='print', stylesheet=None):
+    """Render tests and their references in the background.
+
+    Renders waiting for tests that are not in ``tests`` anymore are
+    cancelled. If a worker dies, the pool can't be used anymore and tests
+    are only rendered when they're displayed.
+
+    """
+    renders = []
+    for test_id in tests:
+        renders.append(
+            (render_key(suite, test_id, media_type, stylesheet), media_type))
+        renders.extend(
+            (render_key(suite, reference), 'print')
+            for references in REFERENCES.get(test_id, {}).values()
+            for reference in references)
+    keys = {render[0][0] for render in renders if render[0] is not None}
+    for key, future in list(RENDERING.items()):
+        if key not in keys:
+            future.cancel()
+    for render, render_media_type in renders:
+        if render is None:
+            continue
+        key, filename, stylesheet_filename = render
+        if key in RENDERING or RENDER_CACHE.get(key) is not None:
+            continue
+        try:
+            future = RENDER_POOL.submit(
+                prefetch_document, key, filename, render_media_type,
+                stylesheet_filename)
+        except BrokenProcessPool:
+            options.prefetch = 0
+            return
+        RENDERING[key] = future
+        future.add_done_callback(
+            lambda future, key=key: RENDERING.pop(key, None))
+
+
+@app.route('/render/suite-<suite>/<path:test_id>')
+@app.route('/render/suite-<suite>/<path:test_id>/media-<media_type>')
+@app.route('/render/suite-<suite>/<path:test_id>/style-<stylesheet>')
+def render(suite, test_id, media_type='print', stylesheet=None):
+    render = render_key(suite, test_id, media_type, stylesheet)
+    if render is None:
+        abort(404)
+    key, filename, stylesheet_filename = render
+    if request.args.get('profile'):
+        # Profiled tests are rendered again, even if they're in the cache
+        _, stats = profile(
+            render_document, key, filename, media_type, stylesheet_filename)
+        os.makedirs(PROFILE_FOLDER, exist_ok=True)
+        stats.dump_stats(os.path.join(PROFILE_FOLDER, key + '.pstats'))
+        functions = hot_functions(
+            stats, request.args.get('top', 20, type=int))
+        profile_url = url_for('render_profile', key=key)
+    elif RENDER_CACHE.get(key) is None:
+        future = RENDERING.get(key)
+        if future is not None:
+            # Being laid out by a background worker
+            try:
+                future.result(timeout=RENDER_TIMEOUT)
+            except (BrokenProcessPool, CancelledError, TimeoutError):
+                RENDERING.pop(key, None)
+        if RENDER_CACHE.get(key) is None:
+            render_document(key, filename, media_type, stylesheet_filename)
+    sizes = RENDER_CACHE.get(key)[0]['pages']
     pages = [
-        'data:image/png;base64,' +
-        b64encode(document.copy([page]).write_png()[0]).decode()
-        for page in document.pages]
+        (url_for('render_page', key=key, page=page), width, height)
+        for page, (width, height) in enumerate(sizes[:options.max_pages])]
+    hidden_pages = len(sizes) - len(pages)
     return render_template('render.html.jinja2', **locals())
 
 
+@app.route('/render-profile/<key>.pstats')
+def render_profile(key):
+    return send_from_directory(
+        PROFILE_FOLDER, key + '.pstats', as_attachment=True,
+        mimetype='application/octet-stream')
+
+
+@app.route('/render-page/<key>/<int:page>.png')
+def render_page(key, page):
+    item = RENDER_CACHE.get(key)
+    if item is None or page >= min(len(item[0]['pages']), options.max_pages):
+        abort(404)
+    info, mtime = item
+    png = RENDER_CACHE.get_page(key, page)
+    if png is None:
+        # Documents laid out by background workers or by previous runs are
+        # laid out again
+        document = DOCUMENTS.get(key) or render_document(key, *info['render'])
+        png = rasterize_page(key, document, page)
+    response = Response(png, mimetype='image/png')
+    # Keys depend on the rendered content, pages never change
+    response.set_etag('%s-%d' % (key, page))
+    response.last_modified = datetime.utcfromtimestamp(int(mtime))
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 60 * 60
+    return response.make_conditional(request)
+
+
+@app.route('/stored-image/<version>/<path:test_id>.png')
+def stored_image(version, test_id):
+    filename = version in result_versions() and test_image(version, test_id)
+    if not filename:
+        abort(404)
+    return send_file(filename, mimetype='image/png', conditional=True)
+
+
 @app.route('/test-data/suite-<suite>/<path:filename>')
 def test_data(suite, filename):
     return send_from_directory(SUITES[suite]['path'], filename)
 
 
-if not options.write or __name__ == '__main__':
-    for suite_name in options.suites or os.listdir(BASE_PATH):
-        add_suite(suite_name)
-
-
 if __name__ == '__main__':
+    options = argparse.ArgumentParser(parents=[parser]).parse_args()
     print('Tested version is %s' % VERSION)
+    start_render_pool()
     app.run(host='0.0.0.0', debug=options.write)
@@ -0,0 +1,234 @@
+"""
+weasysuite.workers
+------------------
+
+A pool of forked worker processes running tests with a wall-clock timeout
+and a memory limit for each task, recycled after a number of tasks or when
+they use too much memory.
+
+:copyright: Copyright 2011-2012 Simon Sapin, 2013-2016 Kozea
+:license: BSD, see LICENSE for details.
+
+"""
+
+import multiprocessing
+import resource
+import signal
+import time
+import traceback
+from multiprocessing.connection import wait
+
+# Workers must inherit the loaded suites and stylesheets, and the scripts
+# using this module can't be imported again by spawned processes.
+CONTEXT = multiprocessing.get_context('fork')
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of the process, when possible."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fd:
+            fd.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """Get the peak resident set size of the process, in kilobytes."""
+    try:
+        with open('/proc/self/status') as fd:
+            for line in fd:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def current_rss():
+    """Get the resident set size of the process, in kilobytes."""
+    try:
+        with open('/proc/self/status') as fd:
+            for line in fd:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return peak_rss()
+
+
+def _work(function, connection, memory):
+    """Run tasks received from ``connection`` until ``None`` is received."""
+    # Let the parent process handle keyboard interrupts
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if memory:
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        try:
+            result = ('done', function(*task))
+        except Exception:
+            result = ('error', traceback.format_exc())
+        connection.send(result + (current_rss(),))
+
+
+class Worker:
+    """A worker process, with the task it's currently running."""
+
+    def __init__(self, function, memory):
+        self.connection, child_connection = CONTEXT.Pipe()
+        self.process = CONTEXT.Process(
+            target=_work, args=(function, child_connection, memory),
+            daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.index = self.task = self.start = None
+        self.tasks = 0
+
+    def run(self, index, task):
+        self.index, self.task, self.start = index, task, time.time()
+        self.tasks += 1
+        self.connection.send(task)
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(1)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.connection.close()
+
+
+class Pool:
+    """Run ``function`` on tasks in a pool of worker processes.
+
+    ``timeout`` is the maximum number of seconds given to each task, and
+    ``memory`` the maximum size of the address space of each worker, in
+    bytes. Workers running out of time or crashing are killed and replaced.
+
+    Workers are also replaced after running ``max_tasks`` tasks, or when
+    their resident set size is greater than ``max_rss`` kilobytes after a
+    task. ``recycled`` is the number of replaced workers.
+
+    """
+    def __init__(self, function, jobs=1, timeout=None, memory=None,
+                 max_tasks=None, max_rss=None):
+        self.function = function
+        self.jobs = max(jobs or 1, 1)
+        self.timeout = timeout
+        self.memory = memory
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.recycled = 0
+
+    def recycle(self, worker, rss):
+        """Check whether a worker has to be replaced after a task."""
+        return bool(
+            (self.max_tasks and worker.tasks >= self.max_tasks) or
+            (self.max_rss and rss > self.max_rss))
+
+    def imap(self, tasks):
+        """Yield ``(task, status, value)`` tuples in the order of ``tasks``.
+
+        ``status`` is ``'done'`` with the returned value, ``'error'`` with
+        the formatted traceback, ``'timeout'`` or ``'killed'`` with a
+        message.
+
+        """
+        tasks = enumerate(tasks)
+        finished = {}
+        next_index = 0
+        idle = [
+            Worker(self.function, self.memory) for _ in range(self.jobs)]
+        busy = []
+        try:
+            while True:
+                while idle:
+                    index, task = next(tasks, (None, None))
+                    if index is None:
+                        break
+                    worker = idle.pop()
+                    worker.run(index, task)
+                    busy.append(worker)
+                if not busy:
+                    break
+
+                timeout = None
+                if self.timeout:
+                    timeout = max(0, min(
+                        worker.start + self.timeout - time.time()
+                        for worker in busy))
+                ready = wait(
+                    [worker.connection for worker in busy] +
+                    [worker.process.sentinel for worker in busy], timeout)
+
+                for worker in list(busy):
+                    status = rss = None
+                    if worker.connection in ready or (
+                            worker.process.sentinel in ready):
+                        try:
+                            if worker.connection.poll():
+                                status, value, rss = (
+                                    worker.connection.recv())
+                        except (EOFError, OSError):
+                            pass
+                        if status is None:
+                            worker.process.join(1)
+                            status, value = 'killed', (
+                                'Worker killed with exit code %s' %
+                                worker.process.exitcode)
+                    elif self.timeout and (
+                            time.time() - worker.start > self.timeout):
+                        status, value = 'timeout', (
+                            'Timeout after %g seconds' % self.timeout)
+                    if status is None:
+                        continue
+                    finished[worker.index] = (worker.task, status, value)
+                    busy.remove(worker)
+                    if status in ('timeout', 'killed'):
+                        worker.kill()
+                        worker = Worker(self.function, self.memory)
+                    elif self.recycle(worker, rss):
+                        worker.stop()
+                        worker = Worker(self.function, self.memory)
+                        self.recycled += 1
+                    idle.append(worker)
+
+                while next_index in finished:
+                    yield finished.pop(next_index)
+                    next_index += 1
+        finally:
+            for worker in idle + busy:
+                worker.stop()
+
+
+def make_pool(function, options):
+    """Get a pool running ``function`` with the command line ``options``.
+
+    Return ``None`` when no option needs worker processes, tasks can then be
+    run in the current process with ``serial``.
+
+    """
+    if (options.jobs or options.timeout or options.memory_limit or
+            options.max_tasks or options.max_rss):
+        return Pool(
+            function, options.jobs, options.timeout,
+            options.memory_limit and options.memory_limit * 1024 * 1024,
+            options.max_tasks, options.max_rss and options.max_rss * 1024)
+
+
+def serial(function, tasks):
+    """Yield ``(task, status, value)`` tuples like ``Pool.imap``, in the
+    current process."""
+    for task in tasks:
+        try:
+            yield task, 'done', function(*task)
+        except Exception:
+            yield task, 'error', traceback.format_exc()